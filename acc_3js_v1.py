@@ -1,7 +1,11 @@
-from flask import Flask, render_template, jsonify
-import sys
-sys.path.append(r"TinyTroupe")
-from tinytroupe.openai_utils import OpenAIClient, LLMRequest
+from flask import Flask, render_template, jsonify, request, Response
+from routing_cache import RoutingDecisionCache, prompt_hash
+from workflow_engine import CompiledWorkflow
+from llm_metrics import observe_llm_call, record_coalesced, record_retry, render_prometheus, PROMETHEUS_CONTENT_TYPE
+from llm_backend import get_backend
+from model_policy import get_policy
+from single_flight import SingleFlight, flight_key
+import json
 import logging
 import os
 
@@ -10,143 +14,180 @@ from dotenv import load_dotenv
 load_dotenv()
 
 
-os.environ["OPENAI_API_KEY"] = os.getenv('SECRET_KEY')
-
-# Configure logging
-logging.getLogger("tinytroupe").setLevel(logging.WARNING)
+# Offline backends (LLM_BACKEND=stub/replay) run without a key
+if os.getenv('SECRET_KEY'):
+    os.environ["OPENAI_API_KEY"] = os.getenv('SECRET_KEY')
 
 app = Flask(__name__)
-client = OpenAIClient()
-
-# Workflow definition
-WORKFLOW = [
-    {
-        "stage": "1. Account Created",
-        "prompt": "What's the first step after account creation?",
-        "next_stage_prompt": "Based on initial account creation data, which verification step should be prioritized?",
-        "color": "#2196F3",
-        "possible_next": ["2. Email Verification", "3. Phone Verification", "5. Review Process"]
-    },
-    {
-        "stage": "2. Email Verification",
-        "prompt": "What happens during email verification?",
-        "next_stage_prompt": "Given the verification result, what should be the next step?",
-        "color": "#00BCD4",
-        "possible_next": ["3. Phone Verification", "5. Review Process", "4. KYC Documents", "9. Closed"]
-    },
-    {
-        "stage": "3. Phone Verification",
-        "prompt": "What happens during phone verification?",
-        "next_stage_prompt": "Based on verification outcome, what's the appropriate next step?",
-        "color": "#FFEB3B",
-        "possible_next": ["2. Email Verification", "4. KYC Documents", "5. Review Process", "9. Closed"]
-    },
-    {
-        "stage": "4. KYC Documents",
-        "prompt": "What happens during KYC document processing?",
-        "next_stage_prompt": "Based on submitted documents, where should this account go?",
-        "color": "#FF9800",
-        "possible_next": ["5. Review Process", "3. Phone Verification", "9. Closed"]
-    },
-    {
-        "stage": "5. Review Process",
-        "prompt": "What checks happen during review?",
-        "next_stage_prompt": "Given the findings, what should be the next stage?",
-        "color": "#E91E63",
-        "possible_next": ["6. Activated", "4. KYC Documents", "3. Phone Verification", "2. Email Verification", "9. Closed"]
-    },
-    {
-        "stage": "6. Activated",
-        "prompt": "What features become available upon activation?",
-        "next_stage_prompt": "Based on initial activity patterns, what monitoring state is appropriate?",
-        "color": "#4CAF50",
-        "possible_next": ["7. Active Usage", "5. Review Process", "8. Dormant"]
-    },
-    {
-        "stage": "7. Active Usage",
-        "prompt": "What monitoring happens during usage?",
-        "next_stage_prompt": "Given recent activity patterns, should the status change?",
-        "color": "#8BC34A",
-        "possible_next": ["8. Dormant", "5. Review Process", "9. Closed"]
-    },
-    {
-        "stage": "8. Dormant",
-        "prompt": "What triggers dormant status?",
-        "next_stage_prompt": "Based on dormancy duration, what should happen to this account?",
-        "color": "#9E9E9E",
-        "possible_next": ["7. Active Usage", "5. Review Process", "9. Closed"]
-    },
-    {
-        "stage": "9. Closed",
-        "prompt": "What are the final steps in account closure?",
-        "next_stage_prompt": None,
-        "color": "#F44336",
-        "possible_next": []
-    }
-]
+
+# Routing model, max_tokens and temperature come from the "acc_3js_v1" entry
+# of workflows/model_policy.json (the structured decision is a few dozen
+# tokens, so generation is capped); ACC_MODEL pins the model. Calls go
+# through the pluggable backend selected by LLM_BACKEND. Invalid answers are
+# retried a bounded number of times before falling back
+ROUTING_MODEL = os.getenv("ACC_MODEL")
+ROUTING_MAX_ATTEMPTS = max(1, int(os.getenv("ROUTING_MAX_ATTEMPTS", 2)))
+
+# Routing decisions are cached per stage; ROUTING_CACHE_POOL > 1 keeps several
+# varied answers per stage and rotates through them
+routing_cache = RoutingDecisionCache(
+    maxsize=int(os.getenv("ROUTING_CACHE_SIZE", 256)),
+    ttl=float(os.getenv("ROUTING_CACHE_TTL", 600)),
+    pool_size=int(os.getenv("ROUTING_CACHE_POOL", 1))
+)
+
+# Identical routing requests that arrive while one is in flight wait for it
+routing_flights = SingleFlight()
+
+# Workflow definition, compiled from workflows/account_routing.json
+WORKFLOW_ENGINE = (
+    CompiledWorkflow.from_file(os.environ["ACCOUNT_WORKFLOW_PATH"])
+    if os.getenv("ACCOUNT_WORKFLOW_PATH")
+    else CompiledWorkflow.load("account_routing")
+)
+WORKFLOW = WORKFLOW_ENGINE.stages
 
 @app.route('/')
 def index():
     return render_template('index.html', workflow=WORKFLOW)
 
-@app.route('/api/next_stage/<int:current_stage>')
-def get_next_stage(current_stage):
-    if current_stage >= len(WORKFLOW) or not WORKFLOW[current_stage]["possible_next"]:
-        return jsonify({"next_stage": None, "reason": "No possible next stage.", "sentiment": "neutral"})
-    
-    try:
-        current = WORKFLOW[current_stage]
+SENTIMENTS = ["positive", "neutral", "negative"]
+
+
+def routing_response_format(current):
+    # The stage name is constrained to the allowed transitions, so the model
+    # cannot answer with an unknown stage or a malformed line
+    return {
+        "type": "json_schema",
+        "json_schema": {
+            "name": "routing_decision",
+            "strict": True,
+            "schema": {
+                "type": "object",
+                "properties": {
+                    "next_stage": {"type": "string", "enum": list(current["possible_next"])},
+                    "reason": {"type": "string"},
+                    "sentiment": {"type": "string", "enum": SENTIMENTS}
+                },
+                "required": ["next_stage", "reason", "sentiment"],
+                "additionalProperties": False
+            }
+        }
+    }
 
-        # Request AI to determine next stage, provide a reason, and sentiment
-        llm_request = LLMRequest(
-            system_prompt=f"""You are a financial compliance AI making decisions about account workflow routing.
+
+def build_routing_prompts(current):
+    system_prompt = f"""You are a financial compliance AI making decisions about account workflow routing.
             Current stage: {current['stage']}
             Possible next stages: {', '.join(current['possible_next'])} \n
             ignore the numbering of the stages and focus on the stage name.
             
             Consider regulatory requirements, risk factors, and business priorities.
-            Respond strictly in the format: Stage Name || Reason for decision || Sentiment.
-            Example: 2. Email Verification || Email verification is prioritized due to compliance needs || Positive""",
-            user_prompt=current["next_stage_prompt"]
-        )
+            Respond with a JSON object: next_stage (one of the possible next stages, exactly as written),
+            reason (one short sentence) and sentiment (positive, neutral or negative)."""
+    return system_prompt, current["next_stage_prompt"]
+
 
-        # Fetch AI response and handle parsing
-        llm_response = llm_request.call().strip()
+def parse_routing_decision(current, text):
+    # Returns (stage_name, reason, sentiment); raises ValueError on anything
+    # that does not match the schema so the caller can retry
+    try:
+        data = json.loads(text)
+    except json.JSONDecodeError as e:
+        raise ValueError(f"Routing response is not valid JSON: {e}")
+    if not isinstance(data, dict):
+        raise ValueError("Routing response is not a JSON object")
+
+    next_stage_name = str(data.get("next_stage", "")).strip()
+    if not WORKFLOW_ENGINE.is_allowed(current["stage"], next_stage_name):
+        raise ValueError(f"Routing response names an invalid next stage: {next_stage_name}")
+    sentiment = str(data.get("sentiment", "neutral")).strip().lower()
+    if sentiment not in SENTIMENTS:
+        sentiment = "neutral"
+    return next_stage_name, str(data.get("reason", "")).strip(), sentiment
+
+
+def request_routing_decision(current, messages, response_format, choice):
+    # Returns (decision, valid); valid is False for the fallback decision.
+    # Schema-constrained output should parse first time; a bounded number
+    # of retries covers providers that ignore the schema
+    error = None
+    for attempt in range(ROUTING_MAX_ATTEMPTS):
+        if attempt:
+            record_retry("acc_3js_v1", current["stage"], choice.model, role="router")
+        with observe_llm_call("acc_3js_v1", current["stage"], choice.model, role="router") as call:
+            result = get_backend().complete_sync(
+                messages,
+                choice.model,
+                response_format=response_format,
+                **choice.params()
+            )
+            call.usage(result.prompt_tokens, result.completion_tokens, result.cached_tokens)
+            choice.usage(result.prompt_tokens, result.completion_tokens)
+        llm_response = (result.text or "").strip()
         logging.debug(f"AI Response for stage {current['stage']}: {llm_response}")
 
-        # Split response using '||' separator
-        parts = llm_response.split('||')
-        if len(parts) != 3:
-            logging.error(f"Malformed AI response: {llm_response}")
-            raise ValueError("Malformed AI response. Expected 'Stage Name || Reason || Sentiment'")
-
-        next_stage_name = parts[0].strip()
-        reason = parts[1].strip()
-        sentiment = parts[2].strip().lower()
-
-        # Validate and find index of next stage
-        for idx, stage in enumerate(WORKFLOW):
-            if stage["stage"] == next_stage_name and next_stage_name in current["possible_next"]:
-                return jsonify({
-                    "next_stage": idx,
-                    "stage_name": next_stage_name,
-                    "reason": reason,
-                    "sentiment": sentiment,
-                    "decision": f"Moving to {next_stage_name} based on compliance analysis."
-                })
-
-        # Log and handle fallback
-        logging.warning(f"AI returned an invalid next stage: {next_stage_name}")
-        fallback_stage = current["possible_next"][0]
-        for idx, stage in enumerate(WORKFLOW):
-            if stage["stage"] == fallback_stage:
-                return jsonify({
-                    "next_stage": idx,
-                    "stage_name": fallback_stage,
-                    "reason": f"Fallback to {fallback_stage} due to: {llm_response}.",
-                    "sentiment": "neutral",
-                    "decision": "Routing to fallback stage."
-                })
+        try:
+            next_stage_name, reason, sentiment = parse_routing_decision(current, llm_response)
+        except ValueError as e:
+            logging.warning(f"Attempt {attempt + 1}/{ROUTING_MAX_ATTEMPTS} for stage {current['stage']}: {e}")
+            error = e
+            continue
+
+        return {
+            "next_stage": WORKFLOW_ENGINE.index_of(next_stage_name),
+            "stage_name": next_stage_name,
+            "reason": reason,
+            "sentiment": sentiment,
+            "decision": f"Moving to {next_stage_name} based on compliance analysis."
+        }, True
+
+    # Log and handle fallback
+    logging.error(f"No valid routing decision for stage {current['stage']}: {error}")
+    fallback_stage = current["possible_next"][0]
+    return {
+        "next_stage": WORKFLOW_ENGINE.index_of(fallback_stage),
+        "stage_name": fallback_stage,
+        "reason": f"Fallback to {fallback_stage} due to: {error}.",
+        "sentiment": "neutral",
+        "decision": "Routing to fallback stage."
+    }, False
+
+@app.route('/api/next_stage/<int:current_stage>')
+def get_next_stage(current_stage):
+    if current_stage >= len(WORKFLOW) or not WORKFLOW[current_stage]["possible_next"]:
+        return jsonify({"next_stage": None, "reason": "No possible next stage.", "sentiment": "neutral"})
+    
+    try:
+        current = WORKFLOW[current_stage]
+        system_prompt, user_prompt = build_routing_prompts(current)
+
+        # The decision only depends on the stage and its static prompts, so
+        # repeated dashboard polls are served from the cache
+        cache_key = (current_stage, prompt_hash(system_prompt, user_prompt))
+        cached = routing_cache.get(cache_key)
+        if cached is not None:
+            return jsonify(dict(cached, cached=True))
+
+        # Request AI to determine next stage, provide a reason, and sentiment
+        messages = [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_prompt}
+        ]
+        response_format = routing_response_format(current)
+
+        # Dashboards polling the same stage at once share one in-flight call
+        with get_policy().use("acc_3js_v1", current["stage"], "router", model=ROUTING_MODEL) as choice:
+            key = flight_key(messages, choice.model, response_format=response_format, **choice.params())
+            (decision, valid), shared = routing_flights.do(
+                key, lambda: request_routing_decision(current, messages, response_format, choice)
+            )
+        if shared:
+            record_coalesced("acc_3js_v1", current["stage"], choice.model, role="router")
+        elif valid:
+            # Only valid decisions are cached; fallbacks should retry the LLM next time
+            routing_cache.put(cache_key, decision)
+        return jsonify(decision)
 
     except Exception as e:
         logging.error(f"Error determining next stage: {e}")
@@ -157,14 +198,15 @@ def get_next_stage(current_stage):
             "sentiment": "neutral"
         })
 
-    # Default response if all else fails
-    return jsonify({
-        "next_stage": None,
-        "reason": "Unable to determine next stage due to unexpected error.",
-        "sentiment": "neutral",
-        "decision": "Routing failed."
-    })
+@app.route('/api/routing_cache', methods=['GET', 'DELETE'])
+def routing_cache_stats():
+    if request.method == 'DELETE':
+        routing_cache.clear()
+    return jsonify(dict(routing_cache.stats(), single_flight=routing_flights.stats()))
 
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return Response(render_prometheus(), mimetype=PROMETHEUS_CONTENT_TYPE)
 
 
 if __name__ == '__main__':
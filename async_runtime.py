@@ -0,0 +1,56 @@
+import asyncio
+import atexit
+import threading
+
+# A single long-lived event loop running in a daemon thread. Flask request
+# threads hand coroutines to it instead of creating a fresh loop per request,
+# so async clients keep their pooled connections and concurrent requests
+# actually overlap while waiting on the network.
+
+_loop = None
+_thread = None
+_lock = threading.Lock()
+
+
+def get_loop():
+    global _loop, _thread
+    with _lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            _thread = threading.Thread(target=_loop.run_forever, name="async-runtime", daemon=True)
+            _thread.start()
+            atexit.register(shutdown)
+        return _loop
+
+
+def run_async(coro, timeout=None):
+    # Blocks the calling (worker) thread until the coroutine finishes on the shared loop
+    future = asyncio.run_coroutine_threadsafe(coro, get_loop())
+    return future.result(timeout)
+
+
+def shutdown():
+    global _loop, _thread
+    with _lock:
+        if _loop is None:
+            return
+        _loop.call_soon_threadsafe(_loop.stop)
+        _thread.join(timeout=5)
+        _loop = None
+        _thread = None
+
+
+def iterate_async(agen, timeout=None):
+    # Drives an async generator on the shared loop from a synchronous caller,
+    # e.g. a Flask streaming response; yields items as they are produced
+    loop = get_loop()
+    try:
+        while True:
+            future = asyncio.run_coroutine_threadsafe(agen.__anext__(), loop)
+            try:
+                yield future.result(timeout)
+            except StopAsyncIteration:
+                return
+    finally:
+        # Client went away or iteration finished: let the generator clean up
+        asyncio.run_coroutine_threadsafe(agen.aclose(), loop).result(timeout)
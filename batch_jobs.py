@@ -0,0 +1,429 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import time
+import uuid
+from datetime import datetime
+
+from async_runtime import run_async
+from llm_backend import LLMResult, OpenAIBackend, get_backend
+from model_policy import get_policy
+
+logger = logging.getLogger(__name__)
+
+# Offline batch mode for bulk simulations. Instead of one interactive
+# chat.completions call per step, every prompt of a round (agent turns, lead
+# replies or persona specifications) is written to a JSONL file in the
+# OpenAI Batch API input format, submitted through a batch executor, and the
+# results are consumed afterwards to advance each lead:
+#
+#   openai - uploads the file to the provider's Batch API (cheaper, up to 24h)
+#   local  - stand-in that runs the file through the configured LLM backend,
+#            e.g. LLM_BACKEND=stub for tests
+#
+# Select one with LLM_BATCH_EXECUTOR. Input and output files are kept in
+# LLM_BATCH_DIR (default batches/) for inspection and re-runs.
+
+ENDPOINT = "/v1/chat/completions"
+TERMINAL_STATES = ("completed", "failed", "expired", "cancelled")
+
+
+class BatchRequest:
+    __slots__ = ("custom_id", "model", "messages", "params")
+
+    def __init__(self, custom_id, model, messages, **params):
+        self.custom_id = custom_id
+        self.model = model
+        self.messages = messages
+        self.params = params
+
+    def to_line(self):
+        return {
+            "custom_id": self.custom_id,
+            "method": "POST",
+            "url": ENDPOINT,
+            "body": dict(self.params, model=self.model, messages=self.messages)
+        }
+
+
+class BatchJobError(RuntimeError):
+    pass
+
+
+def write_batch_file(path, requests):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        for batch_request in requests:
+            f.write(json.dumps(batch_request.to_line()) + "\n")
+    return path
+
+
+def read_batch_results(path):
+    # custom_id -> LLMResult, or the error message for failed requests
+    results = {}
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            response = entry.get("response") or {}
+            body = response.get("body") or {}
+            if entry.get("error") or response.get("status_code") != 200:
+                error = entry.get("error") or body.get("error") or {}
+                results[entry["custom_id"]] = error.get("message") or f"HTTP {response.get('status_code')}"
+                continue
+            usage = body.get("usage") or {}
+            results[entry["custom_id"]] = LLMResult(
+                body["choices"][0]["message"]["content"],
+                body.get("model"),
+                usage.get("prompt_tokens"),
+                usage.get("completion_tokens"),
+                (usage.get("prompt_tokens_details") or {}).get("cached_tokens")
+            )
+    return results
+
+
+class BatchExecutor:
+    name = "base"
+
+    def submit(self, input_path):
+        # Returns a job id
+        raise NotImplementedError
+
+    def wait(self, job_id, output_path):
+        # Blocks until the job finished and writes its output JSONL to output_path
+        raise NotImplementedError
+
+    def run(self, input_path, output_path):
+        job_id = self.submit(input_path)
+        logger.info(f"Submitted batch {job_id} ({self.name}) from {input_path}")
+        return self.wait(job_id, output_path)
+
+
+class OpenAIBatchExecutor(BatchExecutor):
+    name = "openai"
+
+    def __init__(self, backend=None, poll_interval=30, completion_window="24h"):
+        self.backend = backend or OpenAIBackend()
+        self.poll_interval = poll_interval
+        self.completion_window = completion_window
+
+    def submit(self, input_path):
+        client = self.backend.sync_client
+        with open(input_path, "rb") as f:
+            uploaded = client.files.create(file=f, purpose="batch")
+        batch = client.batches.create(
+            input_file_id=uploaded.id,
+            endpoint=ENDPOINT,
+            completion_window=self.completion_window
+        )
+        return batch.id
+
+    def wait(self, job_id, output_path):
+        client = self.backend.sync_client
+        while True:
+            batch = client.batches.retrieve(job_id)
+            if batch.status in TERMINAL_STATES:
+                break
+            logger.info(f"Batch {job_id} is {batch.status}; checking again in {self.poll_interval}s")
+            time.sleep(self.poll_interval)
+
+        if not batch.output_file_id and not batch.error_file_id:
+            raise BatchJobError(f"Batch {job_id} ended as {batch.status} without output")
+        # Successful and failed requests come back in separate files; keep both
+        with open(output_path, "w", encoding="utf-8") as f:
+            for file_id in (batch.output_file_id, batch.error_file_id):
+                if file_id:
+                    f.write(client.files.content(file_id).text)
+        return output_path
+
+
+class LocalBatchExecutor(BatchExecutor):
+    # Runs the batch file through the LLM backend on the shared event loop,
+    # writing output in the same format the provider returns
+    name = "local"
+
+    def __init__(self, backend=None, concurrency=50):
+        self.backend = backend
+        self.concurrency = max(1, int(concurrency))
+        self._jobs = {}
+
+    def submit(self, input_path):
+        job_id = f"local_{uuid.uuid4().hex}"
+        self._jobs[job_id] = input_path
+        return job_id
+
+    async def _execute(self, lines):
+        backend = self.backend or get_backend()
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def run_line(line):
+            body = dict(line["body"])
+            model = body.pop("model")
+            messages = body.pop("messages")
+            async with semaphore:
+                try:
+                    result = await backend.complete(messages, model, **body)
+                except Exception as e:
+                    return {"id": f"batch_req_{uuid.uuid4().hex}", "custom_id": line["custom_id"],
+                            "response": None, "error": {"code": type(e).__name__, "message": str(e)}}
+            return {
+                "id": f"batch_req_{uuid.uuid4().hex}",
+                "custom_id": line["custom_id"],
+                "response": {
+                    "status_code": 200,
+                    "body": {
+                        "model": result.model,
+                        "choices": [{"index": 0, "message": {"role": "assistant", "content": result.text}}],
+                        "usage": {"prompt_tokens": result.prompt_tokens,
+                                  "completion_tokens": result.completion_tokens,
+                                  "prompt_tokens_details": {"cached_tokens": result.cached_tokens or 0}}
+                    }
+                },
+                "error": None
+            }
+
+        return await asyncio.gather(*(run_line(line) for line in lines))
+
+    def wait(self, job_id, output_path):
+        input_path = self._jobs.pop(job_id)
+        with open(input_path, encoding="utf-8") as f:
+            lines = [json.loads(line) for line in f if line.strip()]
+        entries = run_async(self._execute(lines))
+        with open(output_path, "w", encoding="utf-8") as f:
+            for entry in entries:
+                f.write(json.dumps(entry) + "\n")
+        return output_path
+
+
+def build_executor(kind=None):
+    default = "openai" if os.getenv("LLM_BACKEND", "openai").lower() == "openai" else "local"
+    kind = (kind or os.getenv("LLM_BATCH_EXECUTOR", default)).lower()
+    if kind == "openai":
+        return OpenAIBatchExecutor(poll_interval=float(os.getenv("LLM_BATCH_POLL_INTERVAL", 30)))
+    if kind == "local":
+        return LocalBatchExecutor(concurrency=int(os.getenv("LLM_BATCH_LOCAL_CONCURRENCY", 50)))
+    raise ValueError(f"Unknown LLM_BATCH_EXECUTOR: {kind}")
+
+
+class BatchRound:
+    # Writes one round of requests, runs it and returns the parsed results
+    def __init__(self, executor, directory, run_name):
+        self.executor = executor
+        self.directory = directory
+        self.run_name = run_name
+        self.rounds = 0
+
+    def __call__(self, label, requests):
+        if not requests:
+            return {}
+        self.rounds += 1
+        prefix = os.path.join(self.directory, f"{self.run_name}_{self.rounds:03d}_{label}")
+        write_batch_file(f"{prefix}.input.jsonl", requests)
+        output_path = self.executor.run(f"{prefix}.input.jsonl", f"{prefix}.output.jsonl")
+        return read_batch_results(output_path)
+
+
+def _run_name(kind):
+    return f"{kind}_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:6]}"
+
+
+class LeadBatchJob:
+    # Bulk lead simulation in rounds. Each round batches the agent turn of
+    # every active lead, applies the results with complete_step, then (with
+    # lead_replies) batches the leads' replies to those turns. Leads and
+    # turns are persisted through the system's store as in interactive mode.
+
+    def __init__(self, system, executor=None, directory=None, lead_replies=True, max_rounds=20):
+        self.system = system
+        self.executor = executor or build_executor()
+        self.directory = directory or os.getenv("LLM_BATCH_DIR", "batches")
+        self.lead_replies = lead_replies
+        self.max_rounds = max_rounds
+
+    @staticmethod
+    def _request(custom_id, messages, stage, role):
+        # Same tier as the interactive call would use; batches are not under
+        # load-based fallback, their whole point is being off the hot path
+        from troupe_marketing import LLM_MODEL
+
+        choice = get_policy().resolve("troupe_marketing", stage, role)
+        return BatchRequest(custom_id, LLM_MODEL or choice.model, messages, **choice.params())
+
+    def run(self, count, stream=None):
+        from lead_batch import summarize_funnel
+
+        started = time.perf_counter()
+        batch = BatchRound(self.executor, self.directory, _run_name("leads"))
+        leads = dict(run_async(self.system.create_lead(stream)) for _ in range(count))
+        paths = {lead_id: [lead.current_stage] for lead_id, lead in leads.items()}
+        errors = {}
+        active = list(leads)
+
+        for _ in range(self.max_rounds):
+            if not active:
+                break
+
+            requests = []
+            for lead_id in active:
+                lead = leads[lead_id]
+                agent = self.system.agents[lead.current_stage]
+                requests.append(self._request(f"{lead_id}:agent", agent.build_prompt("", lead), agent.stage, "agent"))
+            results = batch("agents", requests)
+
+            still_active = []
+            replies = []
+            # Lead replies are stored under the desk they answer, as in
+            # LeadManagementSystem.run_lead
+            answered = {}
+            for lead_id in active:
+                lead = leads[lead_id]
+                result = results.get(f"{lead_id}:agent")
+                if not isinstance(result, LLMResult):
+                    errors[lead_id] = result or "No batch result"
+                    continue
+                agent = self.system.agents[lead.current_stage]
+                answered[lead_id] = agent.stage
+                step = run_async(self.system.complete_step(lead_id, lead, agent, result.text))
+                if not step["next_stage"]:
+                    continue
+                paths[lead_id].append(step["next_stage"])
+                still_active.append(lead_id)
+                if self.lead_replies:
+                    history = run_async(lead.memory.render())
+                    replies.append(self._request(f"{lead_id}:lead", lead.build_prompt(result.text, history),
+                                                 lead.current_stage, "lead"))
+            active = still_active
+
+            for lead_id, result in batch("leads", replies).items():
+                lead_id = lead_id.rsplit(":", 1)[0]
+                if isinstance(result, LLMResult):
+                    lead = leads[lead_id]
+                    lead.memory.add("Lead", result.text)
+                    self.system.save(lead_id, lead)
+                    self.system.store.append_turn(lead_id, answered[lead_id], "lead", result.text)
+        else:
+            for lead_id in active:
+                errors.setdefault(lead_id, f"Exceeded {self.max_rounds} rounds")
+
+        self.system.store.flush()
+        outcomes = [
+            {
+                "lead_id": lead_id,
+                "client": lead.client["name"],
+                "stream": lead.stream,
+                "path": paths[lead_id],
+                "final_stage": lead.current_stage,
+                "status": lead.status,
+                "error": errors.get(lead_id)
+            }
+            for lead_id, lead in leads.items()
+        ]
+        return {
+            "count": count,
+            "rounds": batch.rounds,
+            "executor": self.executor.name,
+            "elapsed_seconds": round(time.perf_counter() - started, 3),
+            "funnel": summarize_funnel(outcomes),
+            "leads": outcomes
+        }
+
+
+class PersonaBatchJob:
+    # One batch for the whole population, rendered against a shared summary
+    # of the existing names; name collisions are re-requested in follow-up
+    # batches with the colliding names excluded.
+
+    def __init__(self, generator, executor=None, directory=None, max_regen_rounds=3):
+        self.generator = generator
+        self.executor = executor or build_executor()
+        self.directory = directory or os.getenv("LLM_BATCH_DIR", "batches")
+        self.max_regen_rounds = max_regen_rounds
+
+    def run(self, count, quotas=None, existing_names=()):
+        from persona_generator import allocate_quotas
+        from population_summary import normalize_name
+
+        batch = BatchRound(self.executor, self.directory, _run_name("personas"))
+        summary = self.generator.summarize(existing_names)
+        taken = {normalize_name(name) for name in existing_names}
+        pending = [(particularities, ()) for particularities in allocate_quotas(count, quotas)]
+        records = []
+        variant = 0
+
+        model, model_params = self.generator.resolve_model()
+        for _ in range(1 + self.max_regen_rounds):
+            if not pending:
+                break
+            requests = []
+            for i, (particularities, avoid_names) in enumerate(pending):
+                variant += 1
+                messages, params = self.generator.build_request(particularities, summary, avoid_names, variant)
+                requests.append(BatchRequest(f"persona-{i}", model, messages, **dict(model_params, **params)))
+            results = batch("personas", requests)
+
+            collisions = []
+            for i, (particularities, _) in enumerate(pending):
+                result = results.get(f"persona-{i}")
+                if not isinstance(result, LLMResult):
+                    continue
+                try:
+                    record = self.generator.record_from_text(result.text, particularities)
+                except ValueError as e:
+                    logger.warning(f"Unparseable persona in batch: {e}")
+                    continue
+                key = normalize_name(record["name"])
+                if key in taken:
+                    collisions.append((particularities, (record["name"],)))
+                else:
+                    taken.add(key)
+                    records.append(record)
+                    summary.add(record)
+            pending = collisions
+
+        if pending:
+            logger.warning(f"Dropping {len(pending)} personas whose names still collide")
+        return records
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Run lead or persona simulations through the batch API")
+    parser.add_argument("kind", choices=["leads", "personas"])
+    parser.add_argument("--count", type=int, default=100)
+    parser.add_argument("--stream", default=None, help="Lead source stream (leads only)")
+    parser.add_argument("--no-lead-replies", action="store_true", help="Only batch the agent turns")
+    parser.add_argument("--executor", default=None, help="openai or local (default: LLM_BATCH_EXECUTOR)")
+    parser.add_argument("--output", default=None, help="Write the report or personas to this JSON file")
+    args = parser.parse_args()
+
+    executor = build_executor(args.executor)
+    if args.kind == "leads":
+        from troupe_marketing import system
+        report = LeadBatchJob(system, executor, lead_replies=not args.no_lead_replies).run(args.count, args.stream)
+    else:
+        from persona_generator import PersonaGenerator, DEFAULT_CONTEXT, DEFAULT_QUOTAS
+        from persona_pool import PersonaPool
+        # Same population as the persona app. The pool file itself belongs to
+        # that app, so results are submitted as an import it merges in.
+        pool = PersonaPool(None, os.getenv("PERSONA_POOL_PATH", os.path.join("personas", "pool.json")))
+        generator = PersonaGenerator(os.getenv("PERSONA_CONTEXT", DEFAULT_CONTEXT))
+        existing_names = pool.names() | pool.queued_names()
+        records = PersonaBatchJob(generator, executor).run(args.count, quotas=DEFAULT_QUOTAS,
+                                                           existing_names=existing_names)
+        report = {"count": len(records), "import_file": pool.submit_import(records) if records else None,
+                  "personas": records}
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, default=str)
+        print(f"Saved report to {args.output}")
+    else:
+        # Per-lead and per-persona details only go to the output file
+        report.pop("leads", None)
+        report.pop("personas", None)
+        print(json.dumps(report, indent=2, default=str))
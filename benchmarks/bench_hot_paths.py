@@ -0,0 +1,234 @@
+"""Microbenchmarks for the simulation hot paths, run against the offline stub backend.
+
+    python benchmarks/bench_hot_paths.py
+    python benchmarks/bench_hot_paths.py --iterations 2000 --baseline benchmarks/results/<previous>.json
+
+Results (ops/sec and p50/p95/p99 latency per benchmark) are printed and saved
+as JSON. With --baseline, any benchmark whose p50 regressed by more than
+--threshold percent is reported and the script exits non-zero.
+"""
+import argparse
+import asyncio
+import atexit
+import json
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# Configure the apps for an isolated, offline run before importing them
+WORKDIR = tempfile.mkdtemp(prefix="sim_troupe_bench_")
+# Registered first so it runs last, after the apps' own exit handlers flush
+atexit.register(shutil.rmtree, WORKDIR, ignore_errors=True)
+os.environ["LLM_BACKEND"] = "stub"
+os.environ.setdefault("LLM_STUB_LATENCY_MS", "0")
+os.environ["LEAD_DB_PATH"] = os.path.join(WORKDIR, "leads.db")
+os.environ["PERSONA_POOL_PATH"] = os.path.join(WORKDIR, "pool.json")
+os.environ["PERSONA_POOL_SIZE"] = "0"
+
+import llm_backend  # noqa: E402
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def summarize(name, samples):
+    samples = sorted(samples)
+    total = sum(samples)
+    return {
+        "name": name,
+        "iterations": len(samples),
+        "ops_per_sec": round(len(samples) / total, 2) if total else None,
+        "mean_us": round(statistics.fmean(samples) * 1e6, 2),
+        "p50_us": round(percentile(samples, 0.50) * 1e6, 2),
+        "p95_us": round(percentile(samples, 0.95) * 1e6, 2),
+        "p99_us": round(percentile(samples, 0.99) * 1e6, 2)
+    }
+
+
+def bench(name, fn, iterations, warmup=None):
+    for _ in range(warmup if warmup is not None else max(1, iterations // 10)):
+        fn()
+    samples = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - started)
+    return summarize(name, samples)
+
+
+def bench_process_lead(iterations):
+    import troupe_marketing as tm
+    from async_runtime import run_async
+
+    # One sample per step, grouped by the stage the lead was in
+    samples = {}
+    steps = 0
+    while steps < iterations:
+        lead_id, lead = run_async(tm.system.create_lead())
+        while True:
+            stage = lead.current_stage
+            started = time.perf_counter()
+            result = run_async(tm.system.process_lead(lead_id))
+            samples.setdefault(stage, []).append(time.perf_counter() - started)
+            steps += 1
+            if not result["next_stage"]:
+                break
+
+    return [summarize(f"process_lead[{stage}]", values) for stage, values in samples.items()]
+
+
+def bench_determine_next_stage(iterations):
+    import troupe_marketing as tm
+
+    lead = tm.Lead("LinkedIn")
+    lead.current_stage = "Meeting Desk"
+    lead.status.update(assigned_employee="Alice Smith", meeting_completed=True, deal_status="closed")
+    agent = tm.system.agents[lead.current_stage]
+
+    loop = asyncio.new_event_loop()
+    try:
+        return bench("determine_next_stage",
+                     lambda: loop.run_until_complete(tm.system.determine_next_stage(lead, agent)),
+                     iterations)
+    finally:
+        loop.close()
+
+
+class InvalidRoutingStub(llm_backend.StubBackend):
+    # Ignores the response schema and names a stage that does not exist, so
+    # every call goes through the retries and the fallback path
+    def _render(self, messages, model, params):
+        key, result = super()._render(messages, model, {})
+        result.text = json.dumps({"next_stage": "Nowhere", "reason": "Stub reason", "sentiment": "positive"})
+        return key, result
+
+
+def bench_get_next_stage(iterations):
+    import acc_3js_v1 as acc
+
+    client = acc.app.test_client()
+
+    results = []
+    for label, backend in (("parse", llm_backend.StubBackend()), ("fallback", InvalidRoutingStub())):
+        llm_backend.set_backend(backend)
+
+        def call():
+            # Bypass the routing cache so every iteration exercises parsing
+            acc.routing_cache.clear()
+            client.get("/api/next_stage/1")
+
+        results.append(bench(f"get_next_stage[{label}]", call, iterations))
+
+    llm_backend.set_backend(None)
+    return results
+
+
+def bench_generate_personas(iterations, population=500, count=50):
+    import persona
+
+    persona.pool.add([
+        {
+            "name": f"Bench Person {i}",
+            "bio": f"Bench Person {i} is a {20 + i % 45} year old engineer, Portuguese, currently living in Portugal.",
+            "spec": {"age": 20 + i % 45, "nationality": "Portuguese", "occupation": "Engineer"}
+        }
+        for i in range(population)
+    ])
+    client = persona.app.test_client()
+    return [
+        bench(f"generate_personas[count={count}]",
+              lambda: client.get(f"/generate_personas?count={count}"),
+              iterations),
+        bench(f"generate_personas[page,per_page={count},fields=full]",
+              lambda: client.get(f"/generate_personas?page=2&per_page={count}&fields=full"),
+              iterations)
+    ]
+
+
+def bench_prompt_rendering(iterations, population=1000):
+    from persona_generator import PersonaGenerator
+
+    generator = PersonaGenerator("A random person from the target audience", backend=llm_backend.StubBackend())
+    summary = generator.summarize()
+    for i in range(population):
+        summary.add({
+            "name": f"Render Person {i}",
+            "spec": {"age": 18 + i % 47, "nationality": f"Country {i % 30}",
+                     "occupation": f"Occupation {i % 120}", "income_band": "middle"}
+        })
+    return bench(f"render_generator_prompt[population={population}]",
+                 lambda: generator.render_prompt("A person with a high income.", summary),
+                 iterations)
+
+
+def compare(results, baseline_path, threshold):
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = {entry["name"]: entry for entry in json.load(f)["results"]}
+
+    regressions = []
+    for entry in results:
+        previous = baseline.get(entry["name"])
+        if not previous or not previous["p50_us"]:
+            continue
+        change = (entry["p50_us"] - previous["p50_us"]) / previous["p50_us"] * 100
+        entry["p50_change_pct"] = round(change, 1)
+        if change > threshold:
+            regressions.append(entry)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=500)
+    parser.add_argument("--output", default=None, help="Result file (default: benchmarks/results/<timestamp>.json)")
+    parser.add_argument("--baseline", default=None, help="Earlier result file to compare p50 against")
+    parser.add_argument("--threshold", type=float, default=20.0, help="Allowed p50 regression in percent")
+    args = parser.parse_args()
+
+    results = []
+    results.extend(bench_process_lead(args.iterations))
+    results.append(bench_determine_next_stage(args.iterations * 10))
+    results.extend(bench_get_next_stage(args.iterations))
+    results.extend(bench_generate_personas(args.iterations))
+    results.append(bench_prompt_rendering(args.iterations))
+
+    regressions = compare(results, args.baseline, args.threshold) if args.baseline else []
+
+    print(f"{'benchmark':48} {'ops/sec':>12} {'p50 us':>10} {'p95 us':>10} {'p99 us':>10}")
+    for entry in results:
+        change = f"  ({entry['p50_change_pct']:+.1f}%)" if "p50_change_pct" in entry else ""
+        print(f"{entry['name']:48} {entry['ops_per_sec']:>12} {entry['p50_us']:>10} "
+              f"{entry['p95_us']:>10} {entry['p99_us']:>10}{change}")
+
+    output = args.output or os.path.join(ROOT, "benchmarks", "results",
+                                         f"{datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump({
+            "created_at": datetime.now().isoformat(),
+            "python": sys.version.split()[0],
+            "iterations": args.iterations,
+            "results": results
+        }, f, indent=2)
+    print(f"\nSaved results to {output}")
+
+    if regressions:
+        print(f"\n{len(regressions)} benchmark(s) regressed by more than {args.threshold}% at p50:")
+        for entry in regressions:
+            print(f"  {entry['name']}: {entry['p50_change_pct']:+.1f}%")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
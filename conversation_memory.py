@@ -0,0 +1,155 @@
+import logging
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+try:
+    import tiktoken
+    _encoding = tiktoken.get_encoding("cl100k_base")
+except Exception:  # tiktoken missing or its encoding files can't be fetched
+    _encoding = None
+
+
+def count_tokens(text):
+    if not text:
+        return 0
+    if _encoding is not None:
+        return len(_encoding.encode(text))
+    # Rough fallback: ~4 characters per token for English text
+    return max(1, len(text) // 4)
+
+
+class ConversationMemory:
+    # Keeps the last max_recent_turns verbatim and folds anything older into a
+    # running summary, so the prompt size stays flat no matter how long a lead
+    # keeps looping between desks.
+    #
+    # summarize is an async callable (summary, turns) -> new summary. Folding
+    # is deferred until render() so turns that are recorded but never sent to
+    # the model don't trigger summarization calls. Paths that never render
+    # (plain process_lead steps, batch runs) would let pending grow without
+    # limit, so add() caps it by truncating the oldest pending turns into the
+    # summary once there are more than two fold batches or a budget's worth.
+
+    def __init__(self, summarize=None, max_recent_turns=6, token_budget=1200, fold_batch=4):
+        self.summarize = summarize
+        self.max_recent_turns = max_recent_turns
+        self.token_budget = token_budget
+        self.fold_batch = fold_batch
+
+        self.summary = ""
+        self.summary_tokens = 0
+        self.recent = deque()
+        self.recent_tokens = 0
+        self.pending = []
+        self.pending_tokens = 0
+
+        self.total_turns = 0
+        self.total_tokens_seen = 0
+        self.summaries_made = 0
+
+    def add(self, speaker, text):
+        turn = f"{speaker}: {text}"
+        tokens = count_tokens(turn)
+        self.recent.append((turn, tokens))
+        self.recent_tokens += tokens
+        self.total_turns += 1
+        self.total_tokens_seen += tokens
+
+        # Evict by turn count first, then by budget (always keep the latest turn)
+        while len(self.recent) > self.max_recent_turns or (
+            len(self.recent) > 1 and self.recent_tokens > self.token_budget
+        ):
+            old_turn, old_tokens = self.recent.popleft()
+            self.recent_tokens -= old_tokens
+            self.pending.append(old_turn)
+            self.pending_tokens += old_tokens
+
+        if len(self.pending) > 2 * self.fold_batch or self.pending_tokens > self.token_budget:
+            # Keep the newest fold_batch turns for an LLM summary at the next render()
+            keep = self.pending[-self.fold_batch:] if self.fold_batch else []
+            folded = self.pending[:len(self.pending) - len(keep)]
+            self.summary = self._truncate("\n".join([self.summary] + folded))
+            self.summary_tokens = count_tokens(self.summary)
+            self.pending = keep
+            self.pending_tokens = sum(count_tokens(turn) for turn in keep)
+
+    async def refresh_summary(self):
+        if not self.pending:
+            return self.summary
+
+        turns, self.pending = self.pending, []
+        self.pending_tokens = 0
+
+        if self.summarize is not None:
+            try:
+                self.summary = (await self.summarize(self.summary, turns)).strip()
+                self.summaries_made += 1
+            except Exception as e:
+                logger.warning(f"Conversation summarization failed, truncating instead: {e}")
+                self.summary = self._truncate("\n".join([self.summary] + turns))
+        else:
+            self.summary = self._truncate("\n".join([self.summary] + turns))
+
+        self.summary_tokens = count_tokens(self.summary)
+        return self.summary
+
+    def _truncate(self, text):
+        # Keep the tail of the text within a third of the budget
+        limit = max(1, self.token_budget // 3)
+        if count_tokens(text) <= limit:
+            return text.strip()
+        if _encoding is not None:
+            return _encoding.decode(_encoding.encode(text)[-limit:]).strip()
+        return text[-limit * 4:].strip()
+
+    async def render(self):
+        over_budget = self.summary_tokens + self.pending_tokens + self.recent_tokens > self.token_budget
+        if len(self.pending) >= self.fold_batch or (self.pending and over_budget):
+            await self.refresh_summary()
+
+        sections = []
+        if self.summary:
+            sections.append(f"Summary of earlier conversation: {self.summary}")
+        sections.extend(self.pending)
+        sections.extend(turn for turn, _ in self.recent)
+        return "\n".join(sections) if sections else "(no previous conversation)"
+
+    def to_dict(self):
+        return {
+            "summary": self.summary,
+            "recent": [turn for turn, _ in self.recent],
+            "pending": list(self.pending),
+            "total_turns": self.total_turns,
+            "total_tokens_seen": self.total_tokens_seen,
+            "summaries_made": self.summaries_made
+        }
+
+    def load_dict(self, data):
+        self.summary = data.get("summary", "")
+        self.summary_tokens = count_tokens(self.summary)
+        self.recent = deque((turn, count_tokens(turn)) for turn in data.get("recent", []))
+        self.recent_tokens = sum(tokens for _, tokens in self.recent)
+        self.pending = list(data.get("pending", []))
+        self.pending_tokens = sum(count_tokens(turn) for turn in self.pending)
+        self.total_turns = data.get("total_turns", len(self.recent))
+        self.total_tokens_seen = data.get("total_tokens_seen", self.recent_tokens)
+        self.summaries_made = data.get("summaries_made", 0)
+        return self
+
+    @property
+    def turns(self):
+        return [turn for turn, _ in self.recent]
+
+    def token_counts(self):
+        return {
+            "summary_tokens": self.summary_tokens,
+            "pending_tokens": self.pending_tokens,
+            "recent_tokens": self.recent_tokens,
+            "prompt_tokens": self.summary_tokens + self.pending_tokens + self.recent_tokens,
+            "recent_turns": len(self.recent),
+            "total_turns": self.total_turns,
+            "total_tokens_seen": self.total_tokens_seen,
+            "summaries_made": self.summaries_made,
+            "token_budget": self.token_budget
+        }
@@ -0,0 +1,143 @@
+import time
+from collections import Counter
+
+# Incremental funnel analytics. Instead of scanning leads, every created
+# lead and every processed step adds a handful of counter increments to the
+# lead store (through its write-behind buffer, so all workers share them):
+#
+#   occupancy        leads currently at each stage (+1 on entry, -1 on exit)
+#   entered          stage entries, loops included
+#   transition       "From -> To" step counts
+#   created.<dim>    new leads per stream / client
+#   assigned         leads assigned per employee
+#   closed.<dim>     deals closed per stream / client / employee
+#   lost.<dim>       deals lost, same dimensions
+#   onboarded.<dim>  onboarding completed, same dimensions
+#   onboarding_failed.<dim>
+#
+# Each increment is written to bucket 0 (all-time) and to the time bucket it
+# happened in, so a snapshot reads a bounded number of counter rows no
+# matter how many leads exist.
+
+DIMENSIONS = ("stream", "client", "employee")
+OUTCOMES = {
+    ("deal_status", "closed"): "closed",
+    ("deal_status", "lost"): "lost",
+    ("onboarding_status", "complete"): "onboarded",
+    ("onboarding_status", "failed"): "onboarding_failed"
+}
+
+
+class FunnelAggregator:
+    def __init__(self, store, workflow, bucket_seconds=3600):
+        self.store = store
+        self.workflow = workflow
+        self.bucket_seconds = max(1, int(bucket_seconds))
+
+    def _bucket(self, now=None):
+        now = time.time() if now is None else now
+        return int(now // self.bucket_seconds) * self.bucket_seconds
+
+    def _commit(self, increments):
+        bucket = self._bucket()
+        deltas = Counter()
+        for (metric, key), amount in increments.items():
+            deltas[(0, metric, key)] += amount
+            # Occupancy is a current level, not an event count; it only has a total
+            if metric != "occupancy":
+                deltas[(bucket, metric, key)] += amount
+        self.store.increment_counters(deltas)
+
+    @staticmethod
+    def _dimensions(lead):
+        return {
+            "stream": lead.stream,
+            "client": lead.client["name"],
+            "employee": lead.status.get("assigned_employee")
+        }
+
+    def record_created(self, lead):
+        self._commit(Counter({
+            ("occupancy", lead.current_stage): 1,
+            ("entered", lead.current_stage): 1,
+            ("created.stream", lead.stream): 1,
+            ("created.client", lead.client["name"]): 1
+        }))
+
+    def record_step(self, lead, from_stage, previous_status):
+        # Called after a step was saved; lead holds the new stage and status
+        increments = Counter()
+        if lead.current_stage != from_stage:
+            increments[("occupancy", from_stage)] -= 1
+            increments[("occupancy", lead.current_stage)] += 1
+            increments[("entered", lead.current_stage)] += 1
+            increments[("transition", f"{from_stage} -> {lead.current_stage}")] += 1
+
+        employee = lead.status.get("assigned_employee")
+        if employee and employee != previous_status.get("assigned_employee"):
+            increments[("assigned", employee)] += 1
+
+        dimensions = self._dimensions(lead)
+        for (field, value), outcome in OUTCOMES.items():
+            if lead.status.get(field) == value and previous_status.get(field) != value:
+                for dimension in DIMENSIONS:
+                    if dimensions[dimension]:
+                        increments[(f"{outcome}.{dimension}", dimensions[dimension])] += 1
+
+        if increments:
+            self._commit(increments)
+
+    def snapshot(self, window=None):
+        # window: seconds back from now, rounded out to whole buckets; None is all time
+        since = None if window is None else self._bucket(time.time() - window)
+        counters = {}
+        for metric, key, value in self.store.counters(since):
+            counters.setdefault(metric, {})[key] = value
+        if since is not None:
+            # Occupancy is only kept as a total; it is the same for every window
+            occupancy = {key: value for metric, key, value in self.store.counters() if metric == "occupancy"}
+        else:
+            occupancy = counters.get("occupancy", {})
+
+        names = self.workflow.names
+        transitions = counters.get("transition", {})
+        loops = {}
+        for edge, count in transitions.items():
+            source, _, target = edge.partition(" -> ")
+            source_idx = self.workflow.index_of(source)
+            target_idx = self.workflow.index_of(target)
+            # Moving back to an earlier (or the same) desk is a loop
+            if source_idx is not None and target_idx is not None and target_idx <= source_idx:
+                loops[edge] = count
+
+        return {
+            "window_seconds": window,
+            "since": since,
+            "bucket_seconds": self.bucket_seconds,
+            "occupancy": {name: occupancy.get(name, 0) for name in names},
+            "entered": {name: counters.get("entered", {}).get(name, 0) for name in names},
+            "transitions": transitions,
+            "loops": loops,
+            "by_stream": self._rates(counters, "stream", counters.get("created.stream", {})),
+            "by_client": self._rates(counters, "client", counters.get("created.client", {})),
+            "by_employee": self._rates(counters, "employee", counters.get("assigned", {}))
+        }
+
+    @staticmethod
+    def _rates(counters, dimension, totals):
+        # totals: leads per key (created, or assigned for employees)
+        keys = set(totals)
+        for outcome in OUTCOMES.values():
+            keys.update(counters.get(f"{outcome}.{dimension}", {}))
+
+        report = {}
+        for key in sorted(keys):
+            entry = {"leads": totals.get(key, 0)}
+            for outcome in OUTCOMES.values():
+                entry[outcome] = counters.get(f"{outcome}.{dimension}", {}).get(key, 0)
+            decided = entry["closed"] + entry["lost"]
+            onboarding = entry["onboarded"] + entry["onboarding_failed"]
+            entry["close_rate"] = round(entry["closed"] / decided, 4) if decided else 0.0
+            entry["onboarding_rate"] = round(entry["onboarded"] / onboarding, 4) if onboarding else 0.0
+            report[key] = entry
+        return report
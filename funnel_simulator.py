@@ -0,0 +1,274 @@
+import argparse
+import json
+import time
+
+import numpy as np
+
+from lead_catalog import CLIENTS, STREAMS
+from workflow_engine import CompiledWorkflow
+
+# LLM-free Monte Carlo run of the lead workflow. Every lead is a row in a set
+# of NumPy arrays; each step applies the desk side effects from
+# LeadManagementSystem.complete_step with configurable outcome probabilities
+# and then evaluates the compiled workflow transition rules on whole arrays
+# at once, so 10^5-10^7 leads finish in seconds.
+#
+# Status fields are stored as integer codes into these codebooks; the
+# transition conditions (eq / ne / in / not_in / truthy / falsy) are
+# evaluated against the decoded values through per-codebook lookup tables.
+STATUS_CODEBOOKS = {
+    "assigned_employee": [None, "assigned"],
+    "meeting_scheduled": [False, True],
+    "meeting_completed": [False, True],
+    "deal_status": [None, "closed", "lost"],
+    "onboarding_status": [None, "complete", "failed"],
+}
+
+# Outcome probabilities; the real app draws these with random.choice
+DEFAULT_PROBABILITIES = {
+    "assign": 1.0,     # Assign Desk finds an employee for the lead
+    "close": 0.5,      # Meeting Desk closes the deal
+    "onboard": 0.5,    # Onboarding Desk completes onboarding of a closed deal
+}
+
+
+class OutcomeModel:
+    # Probability tables indexed [stream, client]. Overrides are resolved
+    # from most to least specific: "pairs" ("stream|client"), "clients",
+    # "streams", then the defaults.
+
+    def __init__(self, streams, clients, defaults=None, streams_override=None,
+                 clients_override=None, pairs=None):
+        self.streams = list(streams)
+        self.clients = list(clients)
+        defaults = dict(DEFAULT_PROBABILITIES, **(defaults or {}))
+        streams_override = streams_override or {}
+        clients_override = clients_override or {}
+        pairs = pairs or {}
+
+        self.tables = {}
+        for outcome, default in defaults.items():
+            table = np.full((len(self.streams), len(self.clients)), float(default))
+            for s, stream in enumerate(self.streams):
+                for c, client in enumerate(self.clients):
+                    for source in (pairs.get(f"{stream}|{client}"), clients_override.get(client),
+                                   streams_override.get(stream)):
+                        if source and outcome in source:
+                            table[s, c] = float(source[outcome])
+                            break
+            self.tables[outcome] = np.clip(table, 0.0, 1.0)
+
+    @classmethod
+    def from_config(cls, streams, clients, config):
+        config = config or {}
+        return cls(streams, clients, defaults=config.get("defaults"),
+                   streams_override=config.get("streams"), clients_override=config.get("clients"),
+                   pairs=config.get("pairs"))
+
+    def draw(self, outcome, rng, stream_codes, client_codes):
+        probabilities = self.tables[outcome][stream_codes, client_codes]
+        return rng.random(len(probabilities)) < probabilities
+
+
+class FunnelSimulator:
+    def __init__(self, workflow, outcomes, stream_weights=None, client_weights=None, max_steps=50):
+        self.workflow = workflow
+        self.outcomes = outcomes
+        self.max_steps = max_steps
+        self.stream_weights = _normalize(stream_weights, len(outcomes.streams))
+        self.client_weights = _normalize(client_weights, len(outcomes.clients))
+
+        self.stage_count = len(workflow)
+        self.rules = [self._compile_rules(idx) for idx in range(self.stage_count)]
+        self.effects = {
+            workflow.index_of("Assign Desk"): self._assign_effect,
+            workflow.index_of("Meeting Desk"): self._meeting_effect,
+            workflow.index_of("Onboarding Desk"): self._onboarding_effect,
+        }
+        self.effects.pop(None, None)
+
+    def _compile_rules(self, stage_idx):
+        compiled = []
+        for conditions, target_idx in self.workflow.rules[stage_idx]:
+            stage_rule = []
+            for field, op, expected in conditions:
+                if field not in STATUS_CODEBOOKS:
+                    raise ValueError(f"Simulator has no codebook for status field '{field}'")
+                codebook = STATUS_CODEBOOKS[field]
+                # Evaluate the operator once per codebook entry; arrays then index this table
+                table = np.array([bool(op(value, expected)) for value in codebook])
+                stage_rule.append((field, table))
+            compiled.append((stage_rule, target_idx))
+        return compiled
+
+    def _assign_effect(self, state, rows):
+        rows = rows[state["assigned_employee"][rows] == 0]
+        if len(rows):
+            hit = self.outcomes.draw("assign", self.rng, state["stream"][rows], state["client"][rows])
+            state["assigned_employee"][rows[hit]] = 1
+
+    def _meeting_effect(self, state, rows):
+        rows = rows[state["meeting_completed"][rows] == 0]
+        if len(rows):
+            state["meeting_completed"][rows] = 1
+            closed = self.outcomes.draw("close", self.rng, state["stream"][rows], state["client"][rows])
+            state["deal_status"][rows] = np.where(closed, 1, 2)
+
+    def _onboarding_effect(self, state, rows):
+        rows = rows[state["deal_status"][rows] == 1]
+        if len(rows):
+            complete = self.outcomes.draw("onboard", self.rng, state["stream"][rows], state["client"][rows])
+            state["onboarding_status"][rows] = np.where(complete, 1, 2)
+
+    def _next_stage(self, state, stage_idx, rows):
+        # -1 means no transition: the lead finishes at this stage
+        targets = np.full(len(rows), -1, dtype=np.int16)
+        undecided = np.ones(len(rows), dtype=bool)
+        for conditions, target_idx in self.rules[stage_idx]:
+            match = undecided.copy()
+            for field, table in conditions:
+                match &= table[state[field][rows]]
+            targets[match] = target_idx
+            undecided &= ~match
+            if not undecided.any():
+                break
+        return targets
+
+    def run(self, leads, seed=None):
+        started = time.perf_counter()
+        self.rng = np.random.default_rng(seed)
+        stage_count = self.stage_count
+        # Leads enter at the first stage of the workflow definition
+        begun = 0
+
+        state = {field: np.zeros(leads, dtype=np.int8) for field in STATUS_CODEBOOKS}
+        state["stream"] = self.rng.choice(len(self.outcomes.streams), size=leads, p=self.stream_weights)
+        state["client"] = self.rng.choice(len(self.outcomes.clients), size=leads, p=self.client_weights)
+        stage = np.full(leads, begun, dtype=np.int16)
+        active = np.ones(leads, dtype=bool)
+        reached = np.zeros(leads, dtype=np.uint32)
+        reached |= np.uint32(1 << begun)
+        loops = np.zeros(leads, dtype=np.int16)
+        steps_taken = np.zeros(leads, dtype=np.int16)
+        transitions = np.zeros(stage_count * stage_count, dtype=np.int64)
+        occupancy = []
+
+        for _ in range(self.max_steps):
+            if not active.any():
+                break
+            occupancy.append(np.bincount(stage[active], minlength=stage_count))
+            next_stage = np.full(leads, -1, dtype=np.int16)
+
+            for stage_idx in range(stage_count):
+                rows = np.flatnonzero(active & (stage == stage_idx))
+                if not len(rows):
+                    continue
+                effect = self.effects.get(stage_idx)
+                if effect:
+                    effect(state, rows)
+                next_stage[rows] = self._next_stage(state, stage_idx, rows)
+
+            moving = active & (next_stage >= 0)
+            steps_taken[active] += 1
+            transitions += np.bincount(stage[moving].astype(np.int64) * stage_count + next_stage[moving],
+                                       minlength=stage_count * stage_count)
+
+            bits = np.left_shift(np.uint32(1), next_stage[moving].astype(np.uint32))
+            loops[moving] += ((reached[moving] & bits) != 0).astype(np.int16)
+            reached[moving] |= bits
+            stage[moving] = next_stage[moving]
+            # Leads without a next stage were processed at their terminal desk
+            active &= next_stage >= 0
+
+        return self._report(leads, state, stage, active, reached, loops, steps_taken,
+                            transitions.reshape(stage_count, stage_count), occupancy,
+                            time.perf_counter() - started)
+
+    def _report(self, leads, state, stage, active, reached, loops, steps_taken, transitions, occupancy, elapsed):
+        names = self.workflow.names
+        closed = state["deal_status"] == 1
+        onboarded = state["onboarding_status"] == 1
+
+        reached_counts = {name: int(np.count_nonzero(reached & np.uint32(1 << idx))) for idx, name in enumerate(names)}
+
+        def breakdown(codes, labels):
+            totals = np.bincount(codes, minlength=len(labels))
+            closes = np.bincount(codes[closed], minlength=len(labels))
+            onboards = np.bincount(codes[onboarded], minlength=len(labels))
+            return {
+                label: {
+                    "leads": int(totals[i]),
+                    "close_rate": round(float(closes[i] / totals[i]), 4) if totals[i] else 0.0,
+                    "onboarding_rate": round(float(onboards[i] / totals[i]), 4) if totals[i] else 0.0
+                }
+                for i, label in enumerate(labels)
+            }
+
+        occupancy = np.array(occupancy) if occupancy else np.zeros((0, len(names)))
+        return {
+            "leads": leads,
+            "elapsed_seconds": round(elapsed, 3),
+            "unfinished": int(np.count_nonzero(active)),
+            "reached": reached_counts,
+            "conversion": {name: round(count / leads, 4) for name, count in reached_counts.items()},
+            "final_stages": {names[i]: int(n) for i, n in enumerate(np.bincount(stage, minlength=len(names)))},
+            "close_rate": round(float(closed.mean()), 4),
+            "onboarding_rate": round(float(onboarded.mean()), 4),
+            "transitions": {
+                f"{names[src]} -> {names[dst]}": int(transitions[src, dst])
+                for src, dst in zip(*np.nonzero(transitions))
+            },
+            "loops": {
+                "leads_with_loops": int(np.count_nonzero(loops)),
+                "mean": round(float(loops.mean()), 4),
+                "max": int(loops.max()) if leads else 0
+            },
+            "steps": {
+                "mean": round(float(steps_taken.mean()), 3),
+                "max": int(steps_taken.max()) if leads else 0
+            },
+            "occupancy": {
+                "mean": {name: round(float(occupancy[:, i].mean()), 1) for i, name in enumerate(names)}
+                if len(occupancy) else {},
+                "by_step": occupancy.astype(int).tolist()
+            },
+            "by_stream": breakdown(state["stream"], self.outcomes.streams),
+            "by_client": breakdown(state["client"], self.outcomes.clients)
+        }
+
+
+def _normalize(weights, size):
+    if not weights:
+        return np.full(size, 1.0 / size)
+    weights = np.asarray(weights, dtype=float)
+    return weights / weights.sum()
+
+
+def simulate(leads, config=None, seed=None, workflow=None):
+    # config: {"defaults": {...}, "streams": {...}, "clients": {...}, "pairs": {...},
+    #          "stream_weights": [...], "client_weights": [...]}
+    config = config or {}
+    workflow = workflow or CompiledWorkflow.load("lead_management")
+    client_names = [client["name"] for client in CLIENTS]
+    outcomes = OutcomeModel.from_config(STREAMS, client_names, config)
+    simulator = FunnelSimulator(workflow, outcomes, config.get("stream_weights"), config.get("client_weights"))
+    return simulator.run(leads, seed=seed)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Monte Carlo simulation of the lead funnel without LLM calls")
+    parser.add_argument("--leads", type=int, default=100000)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--config", default=None, help="JSON file with outcome probabilities")
+    parser.add_argument("--workflow", default=None, help="Workflow definition file (default: lead_management)")
+    args = parser.parse_args()
+
+    config = None
+    if args.config:
+        with open(args.config, encoding="utf-8") as f:
+            config = json.load(f)
+    workflow = CompiledWorkflow.from_file(args.workflow) if args.workflow else None
+
+    report = simulate(args.leads, config, seed=args.seed, workflow=workflow)
+    report["occupancy"].pop("by_step")
+    print(json.dumps(report, indent=2))
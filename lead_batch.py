@@ -0,0 +1,99 @@
+import asyncio
+import logging
+import time
+from collections import Counter
+
+logger = logging.getLogger(__name__)
+
+# Safety net against leads that never reach a terminal stage
+MAX_STEPS_PER_LEAD = 20
+
+
+class LeadBatchRunner:
+    def __init__(self, system, concurrency=50, max_steps=MAX_STEPS_PER_LEAD):
+        self.system = system
+        self.concurrency = max(1, int(concurrency))
+        self.max_steps = max_steps
+
+    async def run_lead(self, semaphore, stream=None):
+        # Each lead holds a slot for its whole lifecycle so the number of
+        # in-flight conversations never exceeds the concurrency limit
+        async with semaphore:
+            lead_id, lead = await self.system.create_lead(stream)
+            path = [lead.current_stage]
+            error = None
+
+            try:
+                for _ in range(self.max_steps):
+                    # The loop asks for the next step itself right away, and
+                    # a prefetch after its last step would never be consumed
+                    result = await self.system.process_lead(lead_id, prefetch=False)
+                    if not result["next_stage"]:
+                        break
+                    path.append(result["next_stage"])
+                else:
+                    error = f"Exceeded {self.max_steps} steps"
+            except Exception as e:
+                logger.error(f"Batch lead {lead_id} failed at {lead.current_stage}: {e}")
+                error = str(e)
+
+            return {
+                "lead_id": lead_id,
+                "client": lead.client["name"],
+                "stream": lead.stream,
+                "path": path,
+                "final_stage": lead.current_stage,
+                "status": lead.status,
+                "error": error
+            }
+
+    async def run(self, count, stream=None):
+        semaphore = asyncio.Semaphore(self.concurrency)
+        started = time.perf_counter()
+
+        results = await asyncio.gather(
+            *(self.run_lead(semaphore, stream) for _ in range(count))
+        )
+
+        return {
+            "count": count,
+            "concurrency": self.concurrency,
+            "elapsed_seconds": round(time.perf_counter() - started, 3),
+            "funnel": summarize_funnel(results),
+            "leads": results
+        }
+
+
+def summarize_funnel(results):
+    reached = Counter()
+    final_stages = Counter()
+    deal_status = Counter()
+    onboarding_status = Counter()
+    by_stream = {}
+    by_client = {}
+
+    for result in results:
+        # A lead counts once per stage even if it loops back through it
+        for stage in set(result["path"]):
+            reached[stage] += 1
+        final_stages[result["final_stage"]] += 1
+        deal_status[result["status"]["deal_status"] or "none"] += 1
+        onboarding_status[result["status"]["onboarding_status"] or "none"] += 1
+
+        closed = result["status"]["deal_status"] == "closed"
+        for key, bucket in ((result["stream"], by_stream), (result["client"], by_client)):
+            entry = bucket.setdefault(key, {"leads": 0, "closed": 0})
+            entry["leads"] += 1
+            entry["closed"] += int(closed)
+
+    total = len(results)
+    return {
+        "reached": dict(reached),
+        "final_stages": dict(final_stages),
+        "deal_status": dict(deal_status),
+        "onboarding_status": dict(onboarding_status),
+        "close_rate": round(deal_status["closed"] / total, 4) if total else 0.0,
+        "errors": sum(1 for result in results if result["error"]),
+        "by_stream": by_stream,
+        "by_client": by_client
+    }
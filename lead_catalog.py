@@ -0,0 +1,33 @@
+# Static data shared by the lead management app and the funnel simulator
+
+# Client products/services for which leads are being collected
+CLIENTS = [
+    {
+        "name": "TechCloud Solutions",
+        "product": "Cloud Storage Service",
+        "target_market": "Small to Medium Businesses",
+        "price_range": "$50-500/month"
+    },
+    {
+        "name": "SecureNet",
+        "product": "Cybersecurity Suite",
+        "target_market": "Enterprise",
+        "price_range": "$1000-5000/month"
+    },
+    {
+        "name": "DataFlow Analytics",
+        "product": "Business Intelligence Tools",
+        "target_market": "Mid-market Companies",
+        "price_range": "$200-2000/month"
+    }
+]
+
+# Social media platforms (streams) where leads are collected
+STREAMS = ["LinkedIn", "Twitter", "Facebook", "Industry Forums", "Email Campaigns"]
+
+# Sample employees who can be assigned to leads
+EMPLOYEES = [
+    {"name": "Alice Smith", "expertise": ["Cloud Services", "Data Analytics"]},
+    {"name": "Bob Johnson", "expertise": ["Cybersecurity", "Enterprise Solutions"]},
+    {"name": "Carol Williams", "expertise": ["Business Intelligence", "Consulting"]}
+]
@@ -0,0 +1,347 @@
+import atexit
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import Counter
+
+logger = logging.getLogger(__name__)
+
+# SQLite-backed lead storage, shared by every worker process of the app.
+#
+# Lead state is written synchronously with optimistic versioning: each row
+# carries a version, save_lead(expected_version=...) only succeeds if
+# nobody else advanced the lead in the meantime, and per-lead leases keep
+# two workers from running the same step at once. Conversation turns are
+# append-only and, like funnel counter increments, go through a
+# write-behind buffer that the flusher thread writes in a single
+# transaction every flush_interval seconds, or as soon as it reaches
+# batch_size. Appending only takes the short buffer lock, never the
+# connection lock, so callers are not held up by a flush waiting for
+# another worker's write lock. Turn and counter reads flush first, so
+# callers always see their own writes.
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS leads (
+    id TEXT PRIMARY KEY,
+    stage TEXT NOT NULL,
+    stream TEXT NOT NULL,
+    client TEXT NOT NULL,
+    deal_status TEXT,
+    onboarding_status TEXT,
+    assigned_employee TEXT,
+    data TEXT NOT NULL,
+    version INTEGER NOT NULL DEFAULT 1,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_leads_stage ON leads (stage, created_at);
+CREATE INDEX IF NOT EXISTS idx_leads_stream ON leads (stream, created_at);
+CREATE INDEX IF NOT EXISTS idx_leads_client ON leads (client, created_at);
+CREATE INDEX IF NOT EXISTS idx_leads_deal_status ON leads (deal_status, created_at);
+CREATE INDEX IF NOT EXISTS idx_leads_created_at ON leads (created_at);
+
+CREATE TABLE IF NOT EXISTS turns (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    lead_id TEXT NOT NULL,
+    stage TEXT,
+    role TEXT NOT NULL,
+    content TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_turns_lead ON turns (lead_id, id);
+
+-- Funnel analytics counters; bucket 0 holds all-time totals, other
+-- buckets are the start time of a fixed-size window
+CREATE TABLE IF NOT EXISTS funnel_counters (
+    bucket INTEGER NOT NULL,
+    metric TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value INTEGER NOT NULL,
+    PRIMARY KEY (bucket, metric, key)
+);
+
+CREATE TABLE IF NOT EXISTS leases (
+    lead_id TEXT PRIMARY KEY,
+    owner TEXT NOT NULL,
+    expires_at REAL NOT NULL
+);
+"""
+
+FILTERS = ("stage", "stream", "client", "deal_status", "onboarding_status", "assigned_employee")
+
+INSERT_LEAD = """
+INSERT INTO leads (id, stage, stream, client, deal_status, onboarding_status, assigned_employee,
+                   data, version, created_at, updated_at)
+VALUES (:id, :stage, :stream, :client, :deal_status, :onboarding_status, :assigned_employee,
+        :data, 1, :created_at, :updated_at)
+"""
+
+# Compare-and-swap on the version the caller loaded
+UPDATE_LEAD = """
+UPDATE leads SET
+    stage = :stage,
+    deal_status = :deal_status,
+    onboarding_status = :onboarding_status,
+    assigned_employee = :assigned_employee,
+    data = :data,
+    version = version + 1,
+    updated_at = :updated_at
+WHERE id = :id AND version = :expected_version
+"""
+
+INCREMENT_COUNTER = """
+INSERT INTO funnel_counters (bucket, metric, key, value) VALUES (?, ?, ?, ?)
+ON CONFLICT(bucket, metric, key) DO UPDATE SET value = value + excluded.value
+"""
+
+# Takes the lease if it is free, expired, or already held by the same owner
+ACQUIRE_LEASE = """
+INSERT INTO leases (lead_id, owner, expires_at) VALUES (:lead_id, :owner, :expires_at)
+ON CONFLICT(lead_id) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at
+WHERE leases.expires_at < :now OR leases.owner = excluded.owner
+"""
+
+INSERT_TURN = """
+INSERT INTO turns (lead_id, stage, role, content, created_at)
+VALUES (:lead_id, :stage, :role, :content, :created_at)
+"""
+
+
+class LeadConflictError(RuntimeError):
+    # Another request or worker saved the lead since it was loaded
+    pass
+
+
+class LeadBusyError(RuntimeError):
+    # Another request or worker holds the lead's lease
+    pass
+
+
+class LeadStore:
+    def __init__(self, path="leads.db", batch_size=200, flush_interval=1.0, busy_timeout=10.0):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+        # timeout makes writers from other processes wait for the lock instead of failing
+        self._conn = sqlite3.connect(path, timeout=busy_timeout, check_same_thread=False, isolation_level=None)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(SCHEMA)
+        self._migrate()
+
+        # _lock guards the connection; _buffer_lock only the pending writes.
+        # flush() takes _lock before _buffer_lock, nothing takes them the other way round
+        self._lock = threading.RLock()
+        self._buffer_lock = threading.Lock()
+        self._pending_turns = []
+        self._pending_counters = Counter()
+        self._stopped = threading.Event()
+        self._flush_now = threading.Event()
+        self._flusher = None
+        if flush_interval:
+            self._flusher = threading.Thread(target=self._flush_loop, name="lead-store-flush", daemon=True)
+            self._flusher.start()
+        # The flusher is a daemon thread, so drain the buffer on interpreter exit
+        atexit.register(self.close)
+
+    def _migrate(self):
+        # Databases created before lead versioning have no version column
+        columns = {row["name"] for row in self._conn.execute("PRAGMA table_info(leads)")}
+        if "version" not in columns:
+            self._conn.execute("ALTER TABLE leads ADD COLUMN version INTEGER NOT NULL DEFAULT 1")
+
+    def _flush_loop(self):
+        while not self._stopped.is_set():
+            self._flush_now.wait(self.flush_interval)
+            self._flush_now.clear()
+            try:
+                self.flush()
+            except sqlite3.Error as e:
+                logger.error(f"Lead store flush failed: {e}")
+
+    def flush(self):
+        # Batches are taken and written under the connection lock, so two
+        # flushes cannot commit turns out of order
+        with self._lock:
+            with self._buffer_lock:
+                if not self._pending_turns and not self._pending_counters:
+                    return
+                turns, self._pending_turns = self._pending_turns, []
+                pending_counters, self._pending_counters = self._pending_counters, Counter()
+            counters = [key + (value,) for key, value in pending_counters.items() if value]
+            try:
+                self._conn.execute("BEGIN")
+                try:
+                    if turns:
+                        self._conn.executemany(INSERT_TURN, turns)
+                    if counters:
+                        self._conn.executemany(INCREMENT_COUNTER, counters)
+                    self._conn.execute("COMMIT")
+                except Exception:
+                    self._conn.execute("ROLLBACK")
+                    raise
+            except Exception:
+                # Put the batch back in front of anything appended meanwhile
+                with self._buffer_lock:
+                    self._pending_turns[:0] = turns
+                    self._pending_counters.update(pending_counters)
+                raise
+
+    def _buffered(self):
+        # Called with _buffer_lock held after an append
+        if len(self._pending_turns) + len(self._pending_counters) < self.batch_size:
+            return False
+        if self._flusher is not None:
+            self._flush_now.set()
+            return False
+        # No flusher thread (flush_interval=0): the caller flushes itself
+        return True
+
+    @staticmethod
+    def _lead_row(lead_id, record):
+        now = time.time()
+        return {
+            "id": lead_id,
+            "stage": record["current_stage"],
+            "stream": record["stream"],
+            "client": record["client"]["name"],
+            "deal_status": record["status"].get("deal_status"),
+            "onboarding_status": record["status"].get("onboarding_status"),
+            "assigned_employee": record["status"].get("assigned_employee"),
+            "data": json.dumps(record),
+            "created_at": record.get("created_at", now),
+            "updated_at": now
+        }
+
+    def save_lead(self, lead_id, record, expected_version=None):
+        # Written immediately so every worker sees the new state. Without
+        # expected_version the lead is created; otherwise the write only
+        # applies on top of that version. Returns the new version.
+        row = self._lead_row(lead_id, record)
+        with self._lock:
+            if expected_version is None:
+                self._conn.execute(INSERT_LEAD, row)
+                return 1
+            cursor = self._conn.execute(UPDATE_LEAD, dict(row, expected_version=expected_version))
+            if cursor.rowcount != 1:
+                raise LeadConflictError(f"Lead {lead_id} changed since version {expected_version}")
+            return expected_version + 1
+
+    def append_turn(self, lead_id, stage, role, content):
+        with self._buffer_lock:
+            self._pending_turns.append({
+                "lead_id": lead_id,
+                "stage": stage,
+                "role": role,
+                "content": content,
+                "created_at": time.time()
+            })
+            flush = self._buffered()
+        if flush:
+            self.flush()
+
+    def increment_counters(self, deltas):
+        # deltas: {(bucket, metric, key): amount}; repeated increments of the
+        # same counter collapse into one write
+        with self._buffer_lock:
+            self._pending_counters.update(deltas)
+            flush = self._buffered()
+        if flush:
+            self.flush()
+
+    def counters(self, since=None):
+        # All-time totals, or the sum of the buckets starting at or after since
+        with self._lock:
+            self.flush()
+            if since is None:
+                rows = self._conn.execute(
+                    "SELECT metric, key, value FROM funnel_counters WHERE bucket = 0"
+                ).fetchall()
+            else:
+                rows = self._conn.execute(
+                    "SELECT metric, key, SUM(value) AS value FROM funnel_counters "
+                    "WHERE bucket >= ? GROUP BY metric, key",
+                    (max(1, int(since)),)
+                ).fetchall()
+        return [(row["metric"], row["key"], row["value"]) for row in rows]
+
+    def get_lead(self, lead_id):
+        # Returns (record, version), or (None, None) for unknown leads
+        with self._lock:
+            row = self._conn.execute("SELECT data, version FROM leads WHERE id = ?", (lead_id,)).fetchone()
+        return (json.loads(row["data"]), row["version"]) if row else (None, None)
+
+    def get_version(self, lead_id):
+        with self._lock:
+            row = self._conn.execute("SELECT version FROM leads WHERE id = ?", (lead_id,)).fetchone()
+        return row["version"] if row else None
+
+    def acquire_lease(self, lead_id, owner, ttl):
+        now = time.time()
+        with self._lock:
+            cursor = self._conn.execute(ACQUIRE_LEASE, {
+                "lead_id": lead_id, "owner": owner, "expires_at": now + ttl, "now": now
+            })
+        return cursor.rowcount == 1
+
+    def release_lease(self, lead_id, owner):
+        with self._lock:
+            self._conn.execute("DELETE FROM leases WHERE lead_id = ? AND owner = ?", (lead_id, owner))
+
+    def query(self, page=1, per_page=50, **filters):
+        clauses = []
+        params = []
+        for name in FILTERS:
+            value = filters.get(name)
+            if value is not None:
+                clauses.append(f"{name} = ?")
+                params.append(value)
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+
+        per_page = max(1, min(int(per_page), 500))
+        page = max(1, int(page))
+
+        with self._lock:
+            total = self._conn.execute(f"SELECT COUNT(*) FROM leads {where}", params).fetchone()[0]
+            rows = self._conn.execute(
+                f"SELECT id, stage, stream, client, deal_status, onboarding_status, assigned_employee, "
+                f"version, created_at, updated_at FROM leads {where} ORDER BY created_at DESC, id "
+                f"LIMIT ? OFFSET ?",
+                params + [per_page, (page - 1) * per_page]
+            ).fetchall()
+
+        return {
+            "leads": [dict(row) for row in rows],
+            "total": total,
+            "page": page,
+            "per_page": per_page,
+            "pages": (total + per_page - 1) // per_page
+        }
+
+    def turns(self, lead_id, after_id=0, limit=100):
+        limit = max(1, min(int(limit), 500))
+        with self._lock:
+            self.flush()
+            rows = self._conn.execute(
+                "SELECT id, stage, role, content, created_at FROM turns "
+                "WHERE lead_id = ? AND id > ? ORDER BY id LIMIT ?",
+                (lead_id, int(after_id), limit)
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def count(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM leads").fetchone()[0]
+
+    def close(self):
+        if self._stopped.is_set():
+            return
+        self._stopped.set()
+        self._flush_now.set()
+        self.flush()
+        with self._lock:
+            self._conn.close()
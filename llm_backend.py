@@ -0,0 +1,391 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+from llm_metrics import record_backend_retry
+from rate_limiter import build_rate_limiter, estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+# Every LLM call in the three apps goes through one of these backends:
+#
+#   openai  - the real provider, with pooled keep-alive HTTP clients
+#   record  - calls the real provider and appends each exchange to a cassette
+#   replay  - answers from the cassette only, keyed by request hash
+#   stub    - fast deterministic fake with configurable simulated latency
+#
+# so server throughput can be measured without the network. Select one with
+# LLM_BACKEND; see get_backend() for the other environment knobs.
+
+
+class LLMResult:
+    # cached_tokens: prompt tokens the provider served from its prompt cache
+    __slots__ = ("text", "model", "prompt_tokens", "completion_tokens", "cached_tokens")
+
+    def __init__(self, text, model, prompt_tokens=None, completion_tokens=None, cached_tokens=None):
+        self.text = text
+        self.model = model
+        self.prompt_tokens = prompt_tokens
+        self.completion_tokens = completion_tokens
+        self.cached_tokens = cached_tokens
+
+    def to_dict(self):
+        return {
+            "text": self.text,
+            "model": self.model,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "cached_tokens": self.cached_tokens
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data["text"], data["model"], data.get("prompt_tokens"), data.get("completion_tokens"),
+                   data.get("cached_tokens"))
+
+
+def cached_tokens_of(usage):
+    # usage.prompt_tokens_details.cached_tokens, absent on older models and SDKs
+    details = getattr(usage, "prompt_tokens_details", None)
+    return getattr(details, "cached_tokens", None) if details is not None else None
+
+
+class CassetteMissError(LookupError):
+    pass
+
+
+def request_key(messages, model, params):
+    payload = json.dumps({"messages": messages, "model": model, "params": params}, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class LLMBackend:
+    name = "base"
+
+    async def complete(self, messages, model, **params):
+        raise NotImplementedError
+
+    def complete_sync(self, messages, model, **params):
+        raise NotImplementedError
+
+    async def stream(self, messages, model, usage=None, **params):
+        # Backends without native streaming deliver the whole answer as one chunk.
+        # usage, if given, is a callable (prompt_tokens, completion_tokens, cached_tokens).
+        result = await self.complete(messages, model, **params)
+        if usage is not None:
+            usage(result.prompt_tokens, result.completion_tokens, result.cached_tokens)
+        yield result.text
+
+
+class OpenAIBackend(LLMBackend):
+    name = "openai"
+
+    def __init__(self, api_key=None, max_connections=100, max_keepalive=20, limiter=None):
+        self.api_key = api_key or os.getenv("SECRET_KEY")
+        self.max_connections = max_connections
+        self.max_keepalive = max_keepalive
+        # Optional rate_limiter.RateLimiter; it owns retries, so the SDK's own are disabled
+        self.limiter = limiter
+        self._async_client = None
+        self._sync_client = None
+        self._lock = threading.Lock()
+
+    def _limits(self):
+        import httpx
+        return httpx.Limits(
+            max_connections=self.max_connections,
+            max_keepalive_connections=self.max_keepalive,
+            keepalive_expiry=60
+        )
+
+    @property
+    def async_client(self):
+        # One async client with a pooled keep-alive connection set, shared by
+        # every request through the long-lived loop in async_runtime
+        with self._lock:
+            if self._async_client is None:
+                import httpx
+                from openai import AsyncOpenAI
+                self._async_client = AsyncOpenAI(
+                    api_key=self.api_key,
+                    max_retries=0 if self.limiter else 2,
+                    http_client=httpx.AsyncClient(limits=self._limits(), timeout=httpx.Timeout(60.0, connect=10.0))
+                )
+            return self._async_client
+
+    @property
+    def sync_client(self):
+        with self._lock:
+            if self._sync_client is None:
+                import httpx
+                from openai import OpenAI
+                self._sync_client = OpenAI(
+                    api_key=self.api_key,
+                    max_retries=0 if self.limiter else 2,
+                    http_client=httpx.Client(limits=self._limits(), timeout=httpx.Timeout(60.0, connect=10.0))
+                )
+            return self._sync_client
+
+    @staticmethod
+    def _result(response, model):
+        usage = response.usage
+        return LLMResult(
+            response.choices[0].message.content,
+            response.model or model,
+            usage.prompt_tokens if usage else None,
+            usage.completion_tokens if usage else None,
+            cached_tokens_of(usage) if usage else None
+        )
+
+    async def _complete(self, messages, model, params):
+        response = await self.async_client.chat.completions.create(model=model, messages=messages, **params)
+        return self._result(response, model)
+
+    def _complete_sync(self, messages, model, params):
+        response = self.sync_client.chat.completions.create(model=model, messages=messages, **params)
+        return self._result(response, model)
+
+    async def complete(self, messages, model, **params):
+        if self.limiter is None:
+            return await self._complete(messages, model, params)
+        return await self.limiter.call(model, estimate_tokens(messages, params),
+                                       lambda: self._complete(messages, model, params))
+
+    def complete_sync(self, messages, model, **params):
+        if self.limiter is None:
+            return self._complete_sync(messages, model, params)
+        return self.limiter.call_sync(model, estimate_tokens(messages, params),
+                                      lambda: self._complete_sync(messages, model, params))
+
+    async def stream(self, messages, model, usage=None, **params):
+        def create():
+            return self.async_client.chat.completions.create(
+                model=model,
+                messages=messages,
+                stream=True,
+                stream_options={"include_usage": True},
+                **params
+            )
+
+        if self.limiter is None:
+            stream = await create()
+        else:
+            # Retries only cover opening the stream; the slot is held until it is drained
+            estimate = estimate_tokens(messages, params)
+            stream, started = await self.limiter.open_stream(model, estimate, create)
+        final = None
+        try:
+            async for chunk in stream:
+                if chunk.usage:
+                    final = LLMResult(None, model, chunk.usage.prompt_tokens, chunk.usage.completion_tokens,
+                                      cached_tokens_of(chunk.usage))
+                    if usage is not None:
+                        usage(final.prompt_tokens, final.completion_tokens, final.cached_tokens)
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+        finally:
+            if self.limiter is not None:
+                self.limiter.close_stream(model, estimate, started, final)
+
+
+class StubBackend(LLMBackend):
+    # Deterministic: the same request always yields the same text. Latency is
+    # latency_ms +/- jitter_ms, also derived from the request hash so runs are
+    # reproducible. output may contain {key}, {model} and {prompt_tail}.
+    #
+    # Prompt caching is imitated the way the provider does it: a system
+    # message of at least 1024 tokens that was sent before is reported as
+    # cached, in 128-token increments.
+    name = "stub"
+
+    def __init__(self, latency_ms=0, jitter_ms=0, output=None, tokens_per_chunk=4):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.output = output or "Stub response {key} from {model}: acknowledged \"{prompt_tail}\"."
+        self.tokens_per_chunk = tokens_per_chunk
+        self._seen_prefixes = set()
+
+    def _cached_tokens(self, messages):
+        if not messages or messages[0]["role"] != "system":
+            return 0
+        prefix_tokens = len(messages[0]["content"]) // 4
+        if prefix_tokens < 1024:
+            return 0
+        digest = hashlib.sha256(messages[0]["content"].encode("utf-8")).digest()
+        if digest not in self._seen_prefixes:
+            self._seen_prefixes.add(digest)
+            return 0
+        return prefix_tokens // 128 * 128
+
+    def _delay(self, key):
+        if not self.latency_ms and not self.jitter_ms:
+            return 0.0
+        spread = (int(key[:8], 16) / 0xFFFFFFFF) * 2 - 1
+        return max(0.0, (self.latency_ms + spread * self.jitter_ms) / 1000.0)
+
+    def _render(self, messages, model, params):
+        key = request_key(messages, model, params)
+        prompt = "\n".join(message["content"] for message in messages)
+        response_format = params.get("response_format") or {}
+
+        if response_format.get("type") == "json_schema":
+            text = json.dumps(_example_for_schema(response_format["json_schema"]["schema"], key))
+        elif response_format.get("type") == "json_object":
+            text = json.dumps({"name": f"Stub Agent {key[:8]}", "text": f"stub {key[:8]}"})
+        else:
+            tail = " ".join(prompt.split()[-8:])
+            text = self.output.format(key=key[:8], model=model, prompt_tail=tail)
+
+        prompt_tokens = max(1, len(prompt) // 4)
+        completion_tokens = max(1, len(text) // 4)
+        return key, LLMResult(text, model, prompt_tokens, completion_tokens, self._cached_tokens(messages))
+
+    async def complete(self, messages, model, **params):
+        key, result = self._render(messages, model, params)
+        delay = self._delay(key)
+        if delay:
+            await asyncio.sleep(delay)
+        return result
+
+    def complete_sync(self, messages, model, **params):
+        key, result = self._render(messages, model, params)
+        delay = self._delay(key)
+        if delay:
+            time.sleep(delay)
+        return result
+
+    async def stream(self, messages, model, usage=None, **params):
+        key, result = self._render(messages, model, params)
+        words = result.text.split(" ")
+        chunks = [" ".join(words[i:i + self.tokens_per_chunk]) for i in range(0, len(words), self.tokens_per_chunk)]
+        delay = self._delay(key) / max(1, len(chunks))
+        for i, chunk in enumerate(chunks):
+            if delay:
+                await asyncio.sleep(delay)
+            yield chunk if i == len(chunks) - 1 else chunk + " "
+        if usage is not None:
+            usage(result.prompt_tokens, result.completion_tokens, result.cached_tokens)
+
+
+def _example_for_schema(schema, key):
+    # Smallest value that satisfies the (simple) JSON schemas used in this repo
+    kind = schema.get("type")
+    if "enum" in schema:
+        return schema["enum"][int(key[:4], 16) % len(schema["enum"])]
+    if kind == "object":
+        return {name: _example_for_schema(sub, key) for name, sub in schema.get("properties", {}).items()}
+    if kind == "array":
+        return [_example_for_schema(schema.get("items", {}), key)]
+    if kind in ("integer", "number"):
+        return 0
+    if kind == "boolean":
+        return False
+    return f"stub {key[:8]}"
+
+
+class CassetteBackend(LLMBackend):
+    # Record/replay store: one JSON object per line, keyed by the hash of
+    # (messages, model, params). Recording appends; replay never touches the
+    # network and raises CassetteMissError for unknown requests.
+    name = "cassette"
+
+    def __init__(self, path, mode="replay", inner=None):
+        if mode not in ("record", "replay"):
+            raise ValueError(f"Unknown cassette mode: {mode}")
+        if mode == "record" and inner is None:
+            raise ValueError("Recording needs an inner backend")
+        self.path = path
+        self.mode = mode
+        self.inner = inner
+        self.entries = {}
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    self.entries[entry["key"]] = LLMResult.from_dict(entry["result"])
+        logger.info(f"Loaded {len(self.entries)} cassette entries from {self.path}")
+
+    def _save(self, key, result):
+        with self._lock:
+            self.entries[key] = result
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps({"key": key, "result": result.to_dict()}) + "\n")
+
+    def _lookup(self, messages, model, params):
+        key = request_key(messages, model, params)
+        result = self.entries.get(key)
+        if result is None and self.mode == "replay":
+            raise CassetteMissError(f"No cassette entry for request {key[:12]} ({model})")
+        return key, result
+
+    async def complete(self, messages, model, **params):
+        key, result = self._lookup(messages, model, params)
+        if result is None:
+            result = await self.inner.complete(messages, model, **params)
+            self._save(key, result)
+        return result
+
+    def complete_sync(self, messages, model, **params):
+        key, result = self._lookup(messages, model, params)
+        if result is None:
+            result = self.inner.complete_sync(messages, model, **params)
+            self._save(key, result)
+        return result
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def build_backend(kind=None):
+    kind = (kind or os.getenv("LLM_BACKEND", "openai")).lower()
+    if kind == "openai":
+        # Pacing, backoff and adaptive concurrency for every app; LLM_RATE_LIMIT=0 turns it off
+        limiter = None
+        if os.getenv("LLM_RATE_LIMIT", "1") != "0":
+            limiter = build_rate_limiter(on_retry=lambda model, error: record_backend_retry(model))
+        return OpenAIBackend(
+            max_connections=int(os.getenv("LLM_MAX_CONNECTIONS", 100)),
+            max_keepalive=int(os.getenv("LLM_MAX_KEEPALIVE", 20)),
+            limiter=limiter
+        )
+    if kind == "stub":
+        return StubBackend(
+            latency_ms=float(os.getenv("LLM_STUB_LATENCY_MS", 0)),
+            jitter_ms=float(os.getenv("LLM_STUB_JITTER_MS", 0)),
+            output=os.getenv("LLM_STUB_OUTPUT")
+        )
+    if kind in ("record", "replay"):
+        path = os.getenv("LLM_CASSETTE_PATH", os.path.join("cassettes", "llm.jsonl"))
+        inner = build_backend("openai") if kind == "record" else None
+        return CassetteBackend(path, mode=kind, inner=inner)
+    raise ValueError(f"Unknown LLM_BACKEND: {kind}")
+
+
+def get_backend():
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            _backend = build_backend()
+            logger.info(f"Using LLM backend: {_backend.name}")
+        return _backend
+
+
+def set_backend(backend):
+    # Lets benchmarks and scripts swap the backend before any calls are made
+    global _backend
+    with _backend_lock:
+        _backend = backend
@@ -0,0 +1,205 @@
+import asyncio
+import contextvars
+import threading
+import time
+from collections import defaultdict
+
+# In-process LLM call instrumentation shared by all three apps. Each app
+# exposes the collected series on /metrics in the Prometheus text format.
+
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.0, 4.0, 8.0, 16.0, 32.0, 64.0)
+
+LABEL_NAMES = ("app", "stage", "model", "role")
+
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Labels of the observe_llm_call block the current thread or task is in, so
+# code below the call site (the backend's retry loop) can attribute retries
+_current_labels = contextvars.ContextVar("llm_call_labels", default=None)
+
+
+class _Histogram:
+    __slots__ = ("counts", "total", "count")
+
+    def __init__(self):
+        self.counts = [0] * len(LATENCY_BUCKETS)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.total += value
+        self.count += 1
+
+
+class LLMMetrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latency = defaultdict(_Histogram)
+        self.requests = defaultdict(int)
+        self.errors = defaultdict(int)
+        self.retries = defaultdict(int)
+        self.coalesced = defaultdict(int)
+        self.prompt_tokens = defaultdict(int)
+        self.completion_tokens = defaultdict(int)
+        self.cached_tokens = defaultdict(int)
+
+    def observe(self, labels, duration, prompt_tokens=None, completion_tokens=None, error=None, cached_tokens=None,
+                aborted=False):
+        with self._lock:
+            if aborted:
+                # The caller stopped waiting (client disconnect, cancellation);
+                # neither an error nor a complete call's latency
+                self.requests[labels + ("aborted",)] += 1
+                return
+            self.latency[labels].observe(duration)
+            self.requests[labels + ("error" if error else "ok",)] += 1
+            if error:
+                self.errors[labels + (error,)] += 1
+            if prompt_tokens:
+                self.prompt_tokens[labels] += prompt_tokens
+            if completion_tokens:
+                self.completion_tokens[labels] += completion_tokens
+            if cached_tokens:
+                self.cached_tokens[labels] += cached_tokens
+
+    def record_retry(self, app, stage, model, role="agent"):
+        with self._lock:
+            self.retries[(app, stage or "", model, role)] += 1
+
+    def record_coalesced(self, app, stage, model, role="agent"):
+        with self._lock:
+            self.coalesced[(app, stage or "", model, role)] += 1
+
+    def reset(self):
+        with self._lock:
+            for series in (self.latency, self.requests, self.errors, self.retries, self.coalesced,
+                           self.prompt_tokens, self.completion_tokens, self.cached_tokens):
+                series.clear()
+
+    def render(self):
+        with self._lock:
+            lines = []
+
+            lines.append("# HELP llm_request_duration_seconds LLM call latency.")
+            lines.append("# TYPE llm_request_duration_seconds histogram")
+            for labels, histogram in sorted(self.latency.items()):
+                cumulative = 0
+                for bound, count in zip(LATENCY_BUCKETS, histogram.counts):
+                    cumulative += count
+                    lines.append(f"llm_request_duration_seconds_bucket{{{_labels(labels, le=bound)}}} {cumulative}")
+                lines.append(f"llm_request_duration_seconds_bucket{{{_labels(labels, le='+Inf')}}} {histogram.count}")
+                lines.append(f"llm_request_duration_seconds_sum{{{_labels(labels)}}} {histogram.total:.6f}")
+                lines.append(f"llm_request_duration_seconds_count{{{_labels(labels)}}} {histogram.count}")
+
+            _render_counter(lines, "llm_requests_total", "LLM calls by outcome (ok, error, aborted).",
+                            self.requests, LABEL_NAMES + ("outcome",))
+            _render_counter(lines, "llm_errors_total", "Failed LLM calls by exception type.",
+                            self.errors, LABEL_NAMES + ("error",))
+            _render_counter(lines, "llm_retries_total", "Retried LLM calls.",
+                            self.retries, LABEL_NAMES)
+            _render_counter(lines, "llm_coalesced_total", "Calls served by an identical in-flight call.",
+                            self.coalesced, LABEL_NAMES)
+            _render_counter(lines, "llm_prompt_tokens_total", "Prompt tokens sent.",
+                            self.prompt_tokens, LABEL_NAMES)
+            _render_counter(lines, "llm_completion_tokens_total", "Completion tokens received.",
+                            self.completion_tokens, LABEL_NAMES)
+            _render_counter(lines, "llm_cached_prompt_tokens_total", "Prompt tokens served from the provider's prompt cache.",
+                            self.cached_tokens, LABEL_NAMES)
+
+            lines.append("# HELP llm_prompt_cache_hit_ratio Share of prompt tokens served from the prompt cache.")
+            lines.append("# TYPE llm_prompt_cache_hit_ratio gauge")
+            for labels, prompt_tokens in sorted(self.prompt_tokens.items()):
+                ratio = self.cached_tokens.get(labels, 0) / prompt_tokens if prompt_tokens else 0.0
+                lines.append(f"llm_prompt_cache_hit_ratio{{{_labels(labels)}}} {ratio:.4f}")
+
+            return "\n".join(lines) + "\n"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(values, names=LABEL_NAMES, le=None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if le is not None:
+        pairs.append(f'le="{le}"')
+    return ",".join(pairs)
+
+
+def _render_counter(lines, name, help_text, series, names):
+    lines.append(f"# HELP {name} {help_text}")
+    lines.append(f"# TYPE {name} counter")
+    for labels, value in sorted(series.items()):
+        lines.append(f"{name}{{{_labels(labels, names)}}} {value}")
+
+
+METRICS = LLMMetrics()
+
+
+class observe_llm_call:
+    # Times one LLM call; works as both a sync and an async context manager.
+    #
+    #   with observe_llm_call("troupe_marketing", stage, model) as call:
+    #       response = ...
+    #       call.usage(result.prompt_tokens, result.completion_tokens, result.cached_tokens)
+
+    def __init__(self, app, stage, model, role="agent", metrics=METRICS):
+        self.labels = (app, stage or "", model, role)
+        self.metrics = metrics
+        self.prompt_tokens = None
+        self.completion_tokens = None
+        self.cached_tokens = None
+
+    def usage(self, prompt_tokens, completion_tokens, cached_tokens=None):
+        self.prompt_tokens = prompt_tokens
+        self.completion_tokens = completion_tokens
+        self.cached_tokens = cached_tokens
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        # Restored by value rather than token: async generators may exit in another task
+        self._outer_labels = _current_labels.get()
+        _current_labels.set(self.labels)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        _current_labels.set(self._outer_labels)
+        aborted = exc_type is not None and issubclass(exc_type, (GeneratorExit, asyncio.CancelledError))
+        self.metrics.observe(
+            self.labels,
+            time.perf_counter() - self.started,
+            prompt_tokens=self.prompt_tokens,
+            completion_tokens=self.completion_tokens,
+            error=exc_type.__name__ if exc_type and not aborted else None,
+            cached_tokens=self.cached_tokens,
+            aborted=aborted
+        )
+        return False
+
+    async def __aenter__(self):
+        return self.__enter__()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        return self.__exit__(exc_type, exc, tb)
+
+
+def record_retry(app, stage, model, role="agent"):
+    METRICS.record_retry(app, stage, model, role)
+
+
+def record_coalesced(app, stage, model, role="agent"):
+    METRICS.record_coalesced(app, stage, model, role)
+
+
+def record_backend_retry(model):
+    # Retries made inside the LLM backend count against the enclosing call site
+    labels = _current_labels.get() or ("backend", "", model, "agent")
+    METRICS.record_retry(labels[0], labels[1], model, labels[3])
+
+
+def render_prometheus():
+    return METRICS.render()
@@ -0,0 +1,312 @@
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+# Per-stage model tiering. workflows/model_policy.json (or MODEL_POLICY_PATH)
+# names a few tiers (model, max_tokens, temperature, prices) and, per app,
+# which tier each call uses:
+#
+#   "apps": {"<app>": {"default": {...}, "stages": {"<stage>": {...}}, "roles": {"<role>": {...}}}}
+#
+# Entries are merged default -> stage -> role, so a role entry (e.g. the
+# simulated lead's replies) wins over the stage it is speaking in; an entry
+# that names a tier drops the fallback and SLO it would otherwise inherit.
+# An entry may override max_tokens/temperature (null unsets them), and may
+# name a "fallback" tier together with SLO targets:
+#
+#   p95_latency_seconds  over the last LATENCY_WINDOW calls
+#   max_error_rate       over the same window
+#   max_cost_per_minute  in dollars, from the tier prices and reported usage
+#   max_in_flight        concurrent calls on the primary tier
+#
+# A breached latency/error/cost target moves the route to its fallback tier
+# for a cooldown, after which the primary is probed again with fresh
+# samples; a full max_in_flight only sends the overflow to the fallback.
+
+POLICY_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "workflows", "model_policy.json")
+LATENCY_WINDOW = 50
+MIN_SAMPLES = 10
+
+
+class ModelPolicyError(ValueError):
+    pass
+
+
+class ModelChoice:
+    __slots__ = ("tier", "model", "max_tokens", "temperature", "prompt_price", "completion_price", "fallback")
+
+    def __init__(self, tier, model, max_tokens=None, temperature=None, prompt_price=0.0,
+                 completion_price=0.0, fallback=False):
+        self.tier = tier
+        self.model = model
+        self.max_tokens = max_tokens
+        self.temperature = temperature
+        # Dollars per 1k tokens
+        self.prompt_price = prompt_price
+        self.completion_price = completion_price
+        # True when the route's primary tier was skipped because of its SLO
+        self.fallback = fallback
+
+    def params(self):
+        # Request parameters for the backend, without the unset ones
+        params = {}
+        if self.max_tokens is not None:
+            params["max_tokens"] = self.max_tokens
+        if self.temperature is not None:
+            params["temperature"] = self.temperature
+        return params
+
+    def cost(self, prompt_tokens, completion_tokens):
+        return ((prompt_tokens or 0) * self.prompt_price + (completion_tokens or 0) * self.completion_price) / 1000
+
+    def to_dict(self):
+        return {"tier": self.tier, "model": self.model, "max_tokens": self.max_tokens,
+                "temperature": self.temperature, "fallback": self.fallback}
+
+
+class _RouteState:
+    # Recent behaviour of one route's primary tier
+
+    def __init__(self):
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self.errors = deque(maxlen=LATENCY_WINDOW)
+        self.costs = deque()
+        self.in_flight = 0
+        self.degraded_until = 0.0
+        self.degraded_reason = None
+        self.calls = 0
+        self.fallbacks = 0
+
+    def reset(self):
+        self.latencies.clear()
+        self.errors.clear()
+        self.costs.clear()
+
+    def cost_per_minute(self, now):
+        while self.costs and self.costs[0][0] < now - 60:
+            self.costs.popleft()
+        return sum(cost for _, cost in self.costs)
+
+    def p95(self):
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+
+
+class _PolicyCall:
+    # One call under the policy; works as both a sync and an async context
+    # manager, like llm_metrics.observe_llm_call
+    #
+    #   with get_policy().use("persona", "generate_person") as choice:
+    #       result = backend.complete_sync(messages, choice.model, **choice.params())
+    #       choice.usage(result.prompt_tokens, result.completion_tokens)
+
+    def __init__(self, policy, route, choice, state):
+        self.policy = policy
+        self.route = route
+        self.choice = choice
+        # None when the choice is not tracked (pinned, or fallback traffic)
+        self.state = state
+        self.prompt_tokens = None
+        self.completion_tokens = None
+
+    def __getattr__(self, name):
+        return getattr(self.choice, name)
+
+    def usage(self, prompt_tokens, completion_tokens, cached_tokens=None):
+        self.prompt_tokens = prompt_tokens
+        self.completion_tokens = completion_tokens
+
+    def __enter__(self):
+        self.started = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.policy._finish(self, exc_type, time.monotonic() - self.started)
+        return False
+
+    async def __aenter__(self):
+        return self.__enter__()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        return self.__exit__(exc_type, exc, tb)
+
+
+class ModelPolicy:
+    def __init__(self, config=None, cooldown=60.0):
+        config = config or {}
+        self.tiers = config.get("tiers", {})
+        self.apps = config.get("apps", {})
+        self.cooldown = cooldown
+        self._states = {}
+        self._lock = threading.Lock()
+        for app, app_config in self.apps.items():
+            entries = [app_config.get("default", {})]
+            entries += app_config.get("stages", {}).values()
+            entries += app_config.get("roles", {}).values()
+            for entry in entries:
+                for tier in (entry.get("tier"), entry.get("fallback")):
+                    if tier is not None and tier not in self.tiers:
+                        raise ModelPolicyError(f"Model policy for '{app}' names an unknown tier '{tier}'")
+
+    @classmethod
+    def from_file(cls, path, **kwargs):
+        with open(path, encoding="utf-8") as f:
+            return cls(json.load(f), **kwargs)
+
+    def _entry(self, app, stage, role):
+        app_config = self.apps.get(app, {})
+        entry = dict(app_config.get("default", {}))
+        for layer in (app_config.get("stages", {}).get(stage, {}), app_config.get("roles", {}).get(role, {})):
+            if "tier" in layer:
+                # fallback and slo belong to the tier they guard; a layer that
+                # switches tiers only keeps the ones it names itself
+                entry.pop("fallback", None)
+                entry.pop("slo", None)
+            entry.update(layer)
+        return entry
+
+    def _choice(self, tier, entry, fallback=False):
+        spec = dict(self.tiers[tier])
+        # max_tokens/temperature describe what the call needs, so they
+        # override the fallback tier too
+        for field in ("max_tokens", "temperature"):
+            if field in entry:
+                spec[field] = entry[field]
+        return ModelChoice(
+            tier, spec["model"], spec.get("max_tokens"), spec.get("temperature"),
+            spec.get("cost_per_1k_prompt_tokens", 0.0), spec.get("cost_per_1k_completion_tokens", 0.0),
+            fallback=fallback
+        )
+
+    def resolve(self, app, stage=None, role="agent"):
+        # The primary choice, ignoring load; batch jobs and other offline
+        # callers use this directly
+        entry = self._entry(app, stage, role)
+        if "tier" not in entry:
+            raise ModelPolicyError(f"No model policy for app '{app}'")
+        return self._choice(entry["tier"], entry)
+
+    def use(self, app, stage=None, role="agent", model=None):
+        # model pins the call to that model, bypassing tiers and SLOs; the
+        # route's max_tokens and temperature still apply
+        if model is not None:
+            entry = self._entry(app, stage, role)
+            choice = self._choice(entry["tier"], entry) if "tier" in entry else ModelChoice(None, model)
+            choice.model = model
+            return _PolicyCall(self, None, choice, None)
+
+        route = (app, stage, role)
+        entry = self._entry(app, stage, role)
+        if "tier" not in entry:
+            raise ModelPolicyError(f"No model policy for app '{app}'")
+        choice = self._choice(entry["tier"], entry)
+        if not entry.get("fallback"):
+            return _PolicyCall(self, route, choice, None)
+
+        slo = entry.get("slo", {})
+        now = time.monotonic()
+        with self._lock:
+            state = self._states.get(route)
+            if state is None:
+                state = self._states[route] = _RouteState()
+            state.calls += 1
+            degraded = now < state.degraded_until
+            saturated = slo.get("max_in_flight") is not None and state.in_flight >= slo["max_in_flight"]
+            if degraded or saturated:
+                state.fallbacks += 1
+                return _PolicyCall(self, route, self._choice(entry["fallback"], entry, fallback=True), None)
+            if state.degraded_reason is not None:
+                # Cooldown over: probe the primary again with fresh samples
+                logger.info(f"Model policy: {app}/{stage}/{role} back on tier '{entry['tier']}'")
+                state.degraded_reason = None
+                state.reset()
+            state.in_flight += 1
+        return _PolicyCall(self, route, choice, state)
+
+    def _finish(self, call, exc_type, latency):
+        state = call.state
+        if state is None:
+            return
+        slo = self._entry(*call.route).get("slo", {})
+        now = time.monotonic()
+        with self._lock:
+            state.in_flight -= 1
+            if exc_type is not None and not issubclass(exc_type, Exception):
+                # Cancelled, or a stream the consumer stopped reading; says
+                # nothing about the model
+                return
+            failed = exc_type is not None
+            state.errors.append(failed)
+            if not failed:
+                state.latencies.append(latency)
+            if call.prompt_tokens is not None or call.completion_tokens is not None:
+                state.costs.append((now, call.choice.cost(call.prompt_tokens, call.completion_tokens)))
+            reason = self._breach(state, slo, now)
+            if reason is not None and state.degraded_reason is None:
+                state.degraded_until = now + self.cooldown
+                state.degraded_reason = reason
+                logger.warning(f"Model policy: {'/'.join(str(part) for part in call.route)} "
+                               f"falling back for {self.cooldown:.0f}s ({reason})")
+
+    @staticmethod
+    def _breach(state, slo, now):
+        if len(state.errors) >= MIN_SAMPLES and slo.get("max_error_rate") is not None:
+            rate = sum(state.errors) / len(state.errors)
+            if rate > slo["max_error_rate"]:
+                return f"error rate {rate:.2f} > {slo['max_error_rate']}"
+        if len(state.latencies) >= MIN_SAMPLES and slo.get("p95_latency_seconds") is not None:
+            p95 = state.p95()
+            if p95 > slo["p95_latency_seconds"]:
+                return f"p95 latency {p95:.2f}s > {slo['p95_latency_seconds']}s"
+        if slo.get("max_cost_per_minute") is not None:
+            spent = state.cost_per_minute(now)
+            if spent > slo["max_cost_per_minute"]:
+                return f"cost ${spent:.2f}/min > ${slo['max_cost_per_minute']}/min"
+        return None
+
+    def stats(self):
+        now = time.monotonic()
+        with self._lock:
+            return {
+                "/".join(str(part) for part in route): {
+                    "calls": state.calls,
+                    "fallbacks": state.fallbacks,
+                    "in_flight": state.in_flight,
+                    "degraded": now < state.degraded_until,
+                    "degraded_reason": state.degraded_reason if now < state.degraded_until else None,
+                    "p95_latency": round(state.p95(), 3) if state.latencies else None,
+                    "cost_per_minute": round(state.cost_per_minute(now), 4)
+                }
+                for route, state in self._states.items()
+            }
+
+
+def load_policy(path=None):
+    return ModelPolicy.from_file(
+        path or os.getenv("MODEL_POLICY_PATH") or POLICY_PATH,
+        cooldown=float(os.getenv("MODEL_POLICY_COOLDOWN", 60))
+    )
+
+
+_policy = None
+_policy_lock = threading.Lock()
+
+
+def get_policy():
+    global _policy
+    with _policy_lock:
+        if _policy is None:
+            _policy = load_policy()
+        return _policy
+
+
+def set_policy(policy):
+    # For tests and embedding apps
+    global _policy
+    with _policy_lock:
+        _policy = policy
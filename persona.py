@@ -1,40 +1,81 @@
+import json
 import os
 import sys
 import signal
-from flask import Flask, jsonify, render_template
+from flask import Flask, jsonify, render_template, request, Response
 from dotenv import load_dotenv
 sys.path.append('TinyTroupe')
 
 load_dotenv()
 
 
-os.environ["OPENAI_API_KEY"] = os.getenv('SECRET_KEY')
+# Offline backends (LLM_BACKEND=stub/replay) run without a key
+if os.getenv('SECRET_KEY'):
+    os.environ["OPENAI_API_KEY"] = os.getenv('SECRET_KEY')
 # for tinytroupe to work, install:  rich, chevron, pydantic, llama-index, llama-index-readers-web
 
 import random
-import tinytroupe
-from tinytroupe.agent import TinyPerson
-from tinytroupe.factory import TinyPersonFactory
 
 from flask_cors import CORS
+from llm_metrics import observe_llm_call, render_prometheus, PROMETHEUS_CONTENT_TYPE
+from conversation_memory import count_tokens
+from persona_pool import PersonaPool
+from persona_generator import PersonaGenerator, DEFAULT_CONTEXT, DEFAULT_QUOTAS
 
 app = Flask(__name__)
 CORS(app)
 
-# Initialize the TinyPersonFactory
+PARALLEL_SHARDS = int(os.getenv("PERSONA_PARALLEL_SHARDS", 0))
 
-default_template = """People with a broad and diverse range of personalities, interests, backgrounds and socioeconomic status.
-                Focus in particular:
-              - on financial aspects, ensuring we have both people with high and low income.
-              - on aesthetic aspects, ensuring we have people with different tastes."""
-              
-factory = TinyPersonFactory(default_template)
+# TinyPersonFactory always talks to the real provider, so offline backends
+# (stub, record/replay) go through PersonaGenerator instead
+USE_GENERATOR = PARALLEL_SHARDS > 1 or os.getenv("LLM_BACKEND", "openai").lower() != "openai"
 
-# Generate the specified number of personas
-count = 3
-people = factory.generate_people(count, "A random person from the target audience",
-                                    temperature=1.9,
-                                    verbose=True)
+if USE_GENERATOR:
+    factory = None
+else:
+    # Initialize the TinyPersonFactory
+    from tinytroupe.factory import TinyPersonFactory
+    factory = TinyPersonFactory(DEFAULT_CONTEXT)
+
+def person_to_record(person):
+    return {
+        'name': person.name if hasattr(person, 'name') else "Unknown",
+        'bio': person.minibio(),
+        'spec': getattr(person, '_configuration', {})
+    }
+
+
+def generate_personas_batch(count, existing_names):
+    # TinyPersonFactory already avoids names it generated itself in this process
+    particularities = "A random person from the target audience"
+    with observe_llm_call("persona", "generate_people", os.getenv("PERSONA_MODEL_LABEL", "tinytroupe-default"), role="generator") as call:
+        people = factory.generate_people(count, particularities,
+                                            temperature=1.9,
+                                            verbose=True)
+        records = [person_to_record(person) for person in people]
+        # TinyPersonFactory doesn't report usage; estimate it from the context
+        # sent per person and the specs that came back
+        call.usage(count * count_tokens(DEFAULT_CONTEXT + particularities),
+                   count_tokens(json.dumps([record['spec'] for record in records], default=str)))
+    return [record for record in records if record['name'] not in existing_names]
+
+
+generator = PersonaGenerator(DEFAULT_CONTEXT) if USE_GENERATOR else None
+
+
+def generate_personas_parallel(count, existing_names):
+    return generator.generate_parallel(count, quotas=DEFAULT_QUOTAS, shards=max(1, PARALLEL_SHARDS),
+                                       existing_names=existing_names)
+
+
+# Personas are served from disk immediately; generation happens in the background
+pool = PersonaPool(
+    generate_personas_parallel if generator else generate_personas_batch,
+    path=os.getenv("PERSONA_POOL_PATH", os.path.join("personas", "pool.json")),
+    target_size=int(os.getenv("PERSONA_POOL_SIZE", 20)),
+    refill_batch=int(os.getenv("PERSONA_REFILL_BATCH", 3))
+).start()
 
 
 
@@ -43,26 +84,82 @@ def index():
     return render_template('index.html')
 
 
+def parse_fields(value, default=('name', 'bio')):
+    # fields=name, fields=name,bio or fields=full (name, bio and spec)
+    if not value:
+        return default
+    if value == 'full':
+        return PersonaPool.PAGE_FIELDS
+    fields = tuple(field.strip() for field in value.split(','))
+    unknown = [field for field in fields if field not in PersonaPool.PAGE_FIELDS]
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(unknown)}")
+    return fields
+
+
 @app.route('/generate_personas', methods=['GET'])
 def generate_personas():
+    # Two modes: ?count=N hands out personas (the default), while ?page= /
+    # ?per_page= list the whole population read-only, served from a cached
+    # serialization with ETag / If-None-Match support
+    try:
+        fields = parse_fields(request.args.get('fields'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
     try:
-        # Convert the personas to a JSON-serializable format
-        personas = []
-        for person in people:
-            persona_dict = {
-                'name': person.name if hasattr(person, 'name') else "Unknown",
-                'bio': person.minibio(),
-            }
-            personas.append(persona_dict)
-            
-        print("c")
-        
+        if 'count' not in request.args and ('page' in request.args or 'per_page' in request.args):
+            page = request.args.get('page', default=1, type=int)
+            per_page = request.args.get('per_page', default=50, type=int)
+            if page < 1 or not 1 <= per_page <= 1000:
+                return jsonify({'error': 'page must be at least 1 and per_page between 1 and 1000'}), 400
+
+            body, etag = pool.page(page, per_page, fields)
+            response = Response(body, mimetype='application/json')
+            response.set_etag(etag)
+            response.headers['Cache-Control'] = 'no-cache'
+            return response.make_conditional(request)
+
+        count = request.args.get('count', default=3, type=int)
+        if count < 1:
+            return jsonify({'error': 'count must be at least 1'}), 400
+
+        personas = [{field: persona.get(field) for field in fields} for persona in pool.take(count)]
+
         # Return the personas as JSON
-        return jsonify({'personas': personas})
+        return jsonify({'personas': personas, 'pool': pool.stats()})
     
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+# Largest /persona_pool/generate request; bigger populations belong in batch_jobs.py
+PERSONA_GENERATE_MAX_COUNT = int(os.getenv("PERSONA_GENERATE_MAX_COUNT", 200))
+
+@app.route('/persona_pool/generate', methods=['POST'])
+def bulk_generate_personas():
+    # Generates a large batch at once, using sharded parallel generation when enabled
+    try:
+        params = request.get_json(silent=True) or {}
+        count = int(params.get('count', 50))
+        if count < 1:
+            return jsonify({'error': 'count must be at least 1'}), 400
+        if count > PERSONA_GENERATE_MAX_COUNT:
+            # Generation runs inside the request, holding its worker throughout
+            return jsonify({
+                'error': f'count must be at most {PERSONA_GENERATE_MAX_COUNT}',
+                'message': 'Use python batch_jobs.py personas --count N for larger populations'
+            }), 400
+
+        added = pool.add(pool.generate(count, pool.names()))
+        return jsonify({'requested': count, 'added': added, 'pool': pool.stats()})
+
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return Response(render_prometheus(), mimetype=PROMETHEUS_CONTENT_TYPE)
+
 @app.route('/health', methods=['GET'])
 def health_check():
     return jsonify({'status': 'healthy'}), 200
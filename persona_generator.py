@@ -0,0 +1,226 @@
+import json
+import logging
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+from llm_backend import get_backend
+from llm_metrics import observe_llm_call
+from model_policy import get_policy
+from population_summary import PopulationSummary, normalize_name
+from prompt import AGENT_GENERATOR_PREFIX, AGENT_GENERATOR_REQUEST
+from prompt_builder import PromptTemplate, prefixed_messages
+
+logger = logging.getLogger(__name__)
+
+# Renders the agent generator templates from prompt.py and calls the model
+# directly, producing plain {"name", "bio", "spec"} records (the same shape
+# the persona pool stores). The long static prefix is rendered once per
+# generator so the provider can serve it from its prompt cache; only the
+# request part, with a constant-size PopulationSummary rather than every
+# name and minibio generated so far, is rendered per persona.
+#
+# generate_parallel() splits a population into shards that run concurrently.
+# Each shard only summarizes what it generated itself, so shards don't
+# serialize on each other; name collisions across shards are resolved
+# afterwards by targeted regeneration.
+
+# The population the persona app and the persona batch job generate. Kept
+# here rather than in persona.py, which starts the pool when imported.
+DEFAULT_CONTEXT = """People with a broad and diverse range of personalities, interests, backgrounds and socioeconomic status.
+                Focus in particular:
+              - on financial aspects, ensuring we have both people with high and low income.
+              - on aesthetic aspects, ensuring we have people with different tastes."""
+
+# Generation is split over these demographic quotas (mirroring the focus of
+# DEFAULT_CONTEXT)
+DEFAULT_QUOTAS = {
+    "A person with a high income and refined, expensive tastes.": 1,
+    "A person with a high income and simple, practical tastes.": 1,
+    "A person with a low income and bold, unconventional tastes.": 1,
+    "A person with a low income and modest, traditional tastes.": 1
+}
+
+
+def minibio(spec, name):
+    config = spec.get("_configuration", spec)
+    bio = (
+        f"{name} is a {config.get('age', 'unknown age')} year old {config.get('occupation', 'person')}, "
+        f"{config.get('nationality', 'of unknown nationality')}, currently living in "
+        f"{config.get('country_of_residence', 'an unknown country')}."
+    )
+    traits = [item.get("trait") for item in config.get("personality_traits", []) if isinstance(item, dict)]
+    if traits:
+        bio += " " + " ".join(trait for trait in traits[:2] if trait)
+    return bio
+
+
+def allocate_quotas(count, quotas):
+    # Largest-remainder split of count over the weighted particularities
+    if not quotas:
+        return [None] * count
+
+    total = float(sum(quotas.values()))
+    exact = {key: count * weight / total for key, weight in quotas.items()}
+    allocation = {key: int(value) for key, value in exact.items()}
+    remainder = count - sum(allocation.values())
+    for key in sorted(exact, key=lambda k: exact[k] - allocation[k], reverse=True)[:remainder]:
+        allocation[key] += 1
+
+    # Interleave so that every shard receives a proportional slice
+    items = []
+    pending = dict(allocation)
+    while len(items) < count:
+        for key in quotas:
+            if pending[key] > 0:
+                items.append(key)
+                pending[key] -= 1
+    return items
+
+
+PREFIX_TEMPLATE = PromptTemplate(AGENT_GENERATOR_PREFIX)
+REQUEST_TEMPLATE = PromptTemplate(AGENT_GENERATOR_REQUEST)
+
+
+def _parse_agent(text):
+    text = text.strip()
+    if text.startswith("```"):
+        text = re.sub(r"^```(?:json)?\s*|\s*```$", "", text)
+    data = json.loads(text)
+    if not isinstance(data, dict) or not data.get("name"):
+        raise ValueError("Generated agent has no name")
+    return data
+
+
+class PersonaGenerator:
+    def __init__(self, context, backend=None, model=None, temperature=None, max_attempts=3):
+        self.context = context
+        self.backend = backend
+        # Unset model/temperature come from the "persona" entry of the model policy
+        self.model = model or os.getenv("PERSONA_MODEL")
+        if temperature is None and os.getenv("PERSONA_TEMPERATURE"):
+            temperature = os.getenv("PERSONA_TEMPERATURE")
+        self.temperature = float(temperature) if temperature is not None else None
+        self.max_attempts = max_attempts
+        self.prefix = PREFIX_TEMPLATE.render({"context": context})
+
+    def render_prompt(self, particularities, summary, avoid_names=()):
+        # The per-persona part of the prompt; self.prefix precedes it
+        return REQUEST_TEMPLATE.render({
+            "agent_particularities": particularities,
+            "population_summary": summary.render(avoid_names)
+        })
+
+    def build_request(self, particularities, summary, avoid_names=(), variant=None):
+        # (messages, params) for one persona; shared with the batch job mode,
+        # where variant numbers requests that are otherwise rendered identically
+        instruction = "Generate the agent specification now."
+        if variant is not None:
+            instruction += f" This is agent #{variant} of a larger group; make it distinct from the others."
+        messages = prefixed_messages(
+            self.prefix,
+            f"{self.render_prompt(particularities, summary, avoid_names)}\n{instruction}"
+        )
+        params = {"response_format": {"type": "json_object"}}
+        if self.temperature is not None:
+            params["temperature"] = self.temperature
+        return messages, params
+
+    def resolve_model(self):
+        # (model, params) for callers outside the policy's SLO tracking, e.g. batch jobs
+        choice = get_policy().resolve("persona", "generate_person", "generator")
+        return self.model or choice.model, choice.params()
+
+    @staticmethod
+    def record_from_text(text, particularities):
+        # Raises ValueError when the reply is not a usable agent specification
+        spec = _parse_agent(text)
+        return {"name": spec["name"], "bio": minibio(spec, spec["name"]), "spec": spec,
+                "particularities": particularities}
+
+    def generate_one(self, particularities, summary, avoid_names=()):
+        messages, params = self.build_request(particularities, summary, avoid_names)
+        for attempt in range(self.max_attempts):
+            with get_policy().use("persona", "generate_person", "generator", model=self.model) as choice:
+                with observe_llm_call("persona", "generate_person", choice.model, role="generator") as call:
+                    result = (self.backend or get_backend()).complete_sync(
+                        messages, choice.model, **dict(choice.params(), **params)
+                    )
+                    call.usage(result.prompt_tokens, result.completion_tokens, result.cached_tokens)
+                choice.usage(result.prompt_tokens, result.completion_tokens)
+            try:
+                return self.record_from_text(result.text, particularities)
+            except ValueError as e:
+                logger.warning(f"Unparseable persona (attempt {attempt + 1}): {e}")
+        return None
+
+    def summarize(self, existing_names=(), records=()):
+        summary = PopulationSummary()
+        for name in existing_names:
+            summary.add_name(name)
+        for record in records:
+            summary.add(record)
+        return summary
+
+    def generate_shard(self, particularities_list, existing_names=()):
+        # Within a shard generation stays sequential so the summary can steer
+        # the distribution of what this shard has produced so far
+        summary = self.summarize(existing_names)
+        records = []
+        for particularities in particularities_list:
+            record = self.generate_one(particularities, summary)
+            if record is None:
+                continue
+            records.append(record)
+            summary.add(record)
+        return records
+
+    def generate_parallel(self, count, quotas=None, shards=4, existing_names=(), max_regen_rounds=3):
+        items = allocate_quotas(count, quotas)
+        shards = max(1, min(shards, count))
+        slices = [items[i::shards] for i in range(shards)]
+
+        with ThreadPoolExecutor(max_workers=shards) as executor:
+            shard_results = list(executor.map(lambda part: self.generate_shard(part, existing_names), slices))
+
+        records = [record for shard in shard_results for record in shard]
+        return self._dedupe(records, existing_names, max_regen_rounds, shards)
+
+    def _dedupe(self, records, existing_names, max_regen_rounds, workers):
+        taken = {normalize_name(name) for name in existing_names}
+        unique = []
+        collisions = []
+        for record in records:
+            key = normalize_name(record["name"])
+            if key in taken:
+                collisions.append(record)
+            else:
+                taken.add(key)
+                unique.append(record)
+
+        for round_number in range(max_regen_rounds):
+            if not collisions:
+                break
+            logger.info(f"Regenerating {len(collisions)} personas with colliding names (round {round_number + 1})")
+            summary = self.summarize(existing_names, unique)
+
+            with ThreadPoolExecutor(max_workers=min(workers, len(collisions))) as executor:
+                regenerated = list(executor.map(
+                    lambda record: self.generate_one(record["particularities"], summary, [record["name"]]),
+                    collisions
+                ))
+
+            collisions = []
+            for record in regenerated:
+                if record is None:
+                    continue
+                key = normalize_name(record["name"])
+                if key in taken:
+                    collisions.append(record)
+                else:
+                    taken.add(key)
+                    unique.append(record)
+
+        if collisions:
+            logger.warning(f"Dropping {len(collisions)} personas whose names still collide")
+        return unique
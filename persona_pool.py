@@ -0,0 +1,282 @@
+import atexit
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class PersonaPool:
+    # Personas are served from a JSON file on disk so the server can start
+    # without waiting on the LLM. A background thread tops the pool of not
+    # yet handed out personas back up to target_size; take() hands out the
+    # freshest ones and falls back to recycling issued personas if refills
+    # lag behind demand.
+    #
+    # generate is a callable (count, existing_names) -> list of
+    # {"name", "bio", "spec"} records.
+    #
+    # version changes on every hand-out; content_version only when personas
+    # are added. Listing order (issued then available) is stable across
+    # hand-outs, so serialized listing pages are cached per content_version.
+    #
+    # Other processes (batch_jobs.py personas) never write the pool file,
+    # which this process rewrites from memory on every save. They drop their
+    # records into the import directory next to it instead (submit_import);
+    # the background thread merges those in through add() and deletes them.
+
+    PAGE_FIELDS = ("name", "bio", "spec")
+
+    def __init__(self, generate, path, target_size=20, refill_batch=3, retry_delay=30, import_interval=10):
+        self.generate = generate
+        self.path = path
+        self.import_dir = f"{os.path.splitext(path)[0]}.imports"
+        self.import_interval = import_interval
+        self.target_size = target_size
+        self.refill_batch = refill_batch
+        self.retry_delay = retry_delay
+
+        self.available = []
+        self.issued = []
+        self.version = 0
+        self.content_version = 0
+        self._dirty = False
+        self._page_cache = OrderedDict()
+        self._page_cache_size = 256
+        self._recycle_cursor = 0
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.error(f"Could not load persona pool from {self.path}: {e}")
+            return
+
+        with self._lock:
+            self.available = data.get("available", [])
+            self.issued = data.get("issued", [])
+            self.version += 1
+            self.content_version += 1
+        logger.info(f"Loaded {len(self.available)} available and {len(self.issued)} issued personas from {self.path}")
+
+    def save(self):
+        with self._lock:
+            data = {"available": list(self.available), "issued": list(self.issued)}
+            self._dirty = False
+
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # Write then rename so a crash never leaves a truncated pool file
+        with self._save_lock:
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(data, f, indent=2, default=str)
+            os.replace(tmp_path, self.path)
+
+    def submit_import(self, personas):
+        # Hands personas to the process serving this pool; returns the file
+        os.makedirs(self.import_dir, exist_ok=True)
+        path = os.path.join(self.import_dir, f"{time.time_ns()}-{os.getpid()}.json")
+        # Written under a name ingest() skips, then renamed into place
+        with open(f"{path}.tmp", "w", encoding="utf-8") as f:
+            json.dump(personas, f, indent=2, default=str)
+        os.replace(f"{path}.tmp", path)
+        return path
+
+    def _import_files(self):
+        try:
+            names = os.listdir(self.import_dir)
+        except FileNotFoundError:
+            return []
+        return [os.path.join(self.import_dir, name) for name in sorted(names) if name.endswith(".json")]
+
+    def queued_names(self):
+        # Names submitted for import but not merged into the pool yet
+        names = set()
+        for path in self._import_files():
+            try:
+                with open(path, encoding="utf-8") as f:
+                    names.update(persona["name"] for persona in json.load(f))
+            except (OSError, ValueError) as e:
+                logger.warning(f"Could not read persona import {path}: {e}")
+        return names
+
+    def ingest(self):
+        # Merges submitted imports into the pool; returns how many were added
+        added = 0
+        for path in self._import_files():
+            try:
+                with open(path, encoding="utf-8") as f:
+                    personas = json.load(f)
+            except (OSError, ValueError) as e:
+                logger.error(f"Skipping unreadable persona import {path}: {e}")
+                os.replace(path, f"{path}.failed")
+                continue
+            count = self.add(personas)
+            # Only removed once add() has saved them to the pool file
+            os.remove(path)
+            logger.info(f"Imported {count} of {len(personas)} personas from {path}")
+            added += count
+        return added
+
+    def names(self):
+        with self._lock:
+            return {persona["name"] for persona in self.available + self.issued}
+
+    def all(self):
+        with self._lock:
+            return self.issued + self.available
+
+    def size(self):
+        with self._lock:
+            return len(self.available) + len(self.issued)
+
+    def add(self, personas):
+        added = 0
+        with self._lock:
+            known = {persona["name"] for persona in self.available + self.issued}
+            for persona in personas:
+                if persona["name"] in known:
+                    logger.warning(f"Dropping duplicate persona name: {persona['name']}")
+                    continue
+                known.add(persona["name"])
+                self.available.append(persona)
+                added += 1
+            if added:
+                self.version += 1
+                self.content_version += 1
+        if added:
+            self.save()
+        return added
+
+    def take(self, count):
+        with self._lock:
+            handed_out = self.available[:count]
+            del self.available[:count]
+            self.issued.extend(handed_out)
+
+            # Not enough fresh personas yet: recycle previously issued ones
+            # rather than making the request wait on generation
+            while len(handed_out) < count and len(self.issued) > len(handed_out):
+                candidate = self.issued[self._recycle_cursor % len(self.issued)]
+                self._recycle_cursor += 1
+                if candidate not in handed_out:
+                    handed_out.append(candidate)
+
+            if handed_out:
+                self.version += 1
+                self._dirty = True
+
+        # Hand-outs are persisted by the background thread, off the request path
+        if handed_out and self._thread is None:
+            self.save()
+        self._wakeup.set()
+        return handed_out
+
+    def flush(self):
+        if self._dirty:
+            self.save()
+
+    def page(self, page=1, per_page=50, fields=("name", "bio")):
+        # Returns (serialized JSON bytes, etag) for one listing page
+        fields = tuple(field for field in self.PAGE_FIELDS if field in fields)
+        key = (page, per_page, fields)
+        with self._lock:
+            cached = self._page_cache.get(key)
+            if cached is not None and cached[0] == self.content_version:
+                self._page_cache.move_to_end(key)
+                return cached[1], cached[2]
+            content_version = self.content_version
+            population = self.issued + self.available
+
+        start = (page - 1) * per_page
+        body = json.dumps({
+            "personas": [
+                {field: persona.get(field) for field in fields}
+                for persona in population[start:start + per_page]
+            ],
+            "page": page,
+            "per_page": per_page,
+            "total": len(population),
+            "pages": (len(population) + per_page - 1) // per_page,
+            "fields": list(fields),
+            "content_version": content_version
+        }, separators=(",", ":"), default=str).encode("utf-8")
+        etag = hashlib.sha256(body).hexdigest()[:32]
+
+        with self._lock:
+            self._page_cache[key] = (content_version, body, etag)
+            self._page_cache.move_to_end(key)
+            while len(self._page_cache) > self._page_cache_size:
+                self._page_cache.popitem(last=False)
+        return body, etag
+
+    def refill(self):
+        # Top the available pool up to the target; returns how many were added
+        added = 0
+        while not self._stopped.is_set():
+            with self._lock:
+                missing = self.target_size - len(self.available)
+            if missing <= 0:
+                break
+
+            batch = min(missing, self.refill_batch)
+            batch_added = self.add(self.generate(batch, self.names()) or [])
+            if not batch_added:
+                break
+            added += batch_added
+        return added
+
+    def _run(self):
+        while not self._stopped.is_set():
+            # Cleared before the work rather than after the wait, so a take()
+            # that happens while flushing or refilling wakes the next round
+            self._wakeup.clear()
+            try:
+                self.ingest()
+                self.flush()
+                self.refill()
+                # Wakes up periodically to pick up submitted imports
+                self._wakeup.wait(self.import_interval)
+            except Exception as e:
+                logger.error(f"Persona pool refill failed: {e}")
+                self._wakeup.wait(self.retry_delay)
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="persona-pool-refill", daemon=True)
+            self._thread.start()
+            # The thread is a daemon; persist pending hand-outs on exit
+            atexit.register(self.flush)
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        self._wakeup.set()
+        self.flush()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "available": len(self.available),
+                "issued": len(self.issued),
+                "target_size": self.target_size,
+                "version": self.version,
+                "content_version": self.content_version,
+                "refilling": self._thread is not None and self._thread.is_alive()
+            }
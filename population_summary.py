@@ -0,0 +1,91 @@
+import re
+from collections import Counter
+
+# Constant-size description of an already generated population, rendered
+# into the agent generator template instead of every name and minibio. The
+# prompt only ever carries the top categories per dimension and the most
+# frequent first names/surnames, so its size stays flat as the population
+# grows; exact name uniqueness is enforced after generation instead.
+
+AGE_BANDS = ((18, 24), (25, 34), (35, 44), (45, 54), (55, 65))
+
+DIMENSIONS = ("age", "nationality", "occupation", "income_band")
+
+
+def normalize_name(name):
+    return re.sub(r"\s+", " ", name or "").strip().lower()
+
+
+def age_band(age):
+    try:
+        age = int(age)
+    except (TypeError, ValueError):
+        return "unknown"
+    for low, high in AGE_BANDS:
+        if low <= age <= high:
+            return f"{low}-{high}"
+    return "under 18" if age < 18 else "over 65"
+
+
+class PopulationSummary:
+    def __init__(self, max_categories=8, max_excluded_names=30):
+        self.max_categories = max_categories
+        self.max_excluded_names = max_excluded_names
+        self.size = 0
+        self.histograms = {dimension: Counter() for dimension in DIMENSIONS}
+        self.first_names = Counter()
+        self.surnames = Counter()
+        self.names = set()
+
+    def add_name(self, name):
+        key = normalize_name(name)
+        if not key or key in self.names:
+            return
+        self.names.add(key)
+        parts = name.split()
+        self.first_names[parts[0]] += 1
+        if len(parts) > 1:
+            self.surnames[parts[-1]] += 1
+
+    def add(self, record):
+        spec = record.get("spec", {})
+        config = spec.get("_configuration", spec)
+        self.size += 1
+        self.histograms["age"][age_band(config.get("age"))] += 1
+        self.histograms["nationality"][config.get("nationality") or "unknown"] += 1
+        self.histograms["occupation"][config.get("occupation") or "unknown"] += 1
+        self.histograms["income_band"][config.get("income_band") or "unknown"] += 1
+        self.add_name(record["name"])
+
+    def contains(self, name):
+        return normalize_name(name) in self.names
+
+    def _render_histogram(self, counter):
+        top = counter.most_common(self.max_categories)
+        rest = sum(counter.values()) - sum(count for _, count in top)
+        buckets = [f"{label} ({count})" for label, count in top]
+        if rest:
+            buckets.append(f"other ({rest})")
+        return ", ".join(buckets)
+
+    def excluded_names(self, extra=()):
+        half = self.max_excluded_names // 2
+        common = [name for name, _ in self.first_names.most_common(half)]
+        common += [name for name, _ in self.surnames.most_common(half)]
+        return list(extra) + common
+
+    def render(self, avoid_names=()):
+        # Template context; None makes the mustache section fall back to its
+        # "no agents yet" branch
+        excluded = self.excluded_names(avoid_names)
+        if not self.size and not excluded:
+            return None
+        return {
+            "population_size": self.size,
+            "known_names": len(self.names),
+            "histograms": [
+                {"dimension": dimension.replace("_", " "), "buckets": self._render_histogram(self.histograms[dimension])}
+                for dimension in DIMENSIONS if self.histograms[dimension]
+            ],
+            "excluded_names": ", ".join(excluded)
+        }
@@ -1,25 +1,16 @@
-"""
+# Agent generator templates, rendered with chevron (mustache) by persona_generator.py.
+#
+# The prompt is split for provider-side prompt caching: AGENT_GENERATOR_PREFIX
+# holds everything that is the same for every persona of a generator (rules,
+# format, the long examples and the general context) and is sent first as the
+# system message; AGENT_GENERATOR_REQUEST holds what changes per persona and
+# is sent after it as the user message.
+AGENT_GENERATOR_PREFIX = """
 
 # Agent Generator
 
 Please generate an agent specification based on a general context and the particularities of the agent (if any). The generated agent specification will be used in a simulation to realistically represent a real person.
 
-## General Context
-The general context is the following. 
-
-{{context}}.
-
-## Agent Particularities
-{{#agent_particularities}}
-The agent particularities, in turn, are: {{agent_particularities}}.
-
-These are the specific context details that you must consider, together with the general context, when generating the agent.
-{{/agent_particularities}}
-{{^agent_particularities}}
-There are no agent particularities in this case, so just generate an agent based on the general
-context.
-{{/agent_particularities}}
-
 ## Generation Rules
 
 To generate the requested agents, you **must** to follow these directives:
@@ -37,6 +28,7 @@ To generate the requested agents, you **must** to follow these directives:
             "nationality": "<Generate a nationality based on the context>",
             "country_of_residence": "<Generate a country of residence based on the context text>",
             "occupation": "<Generate an occupation based on the context text>",
+            "income_band": "<One of: low, lower-middle, middle, upper-middle, high>",
             "occupation_description": "<Generate a description of the occupation based on the context text>",
             "routines": [ {"routine": "<Generate a routine description pair based on the context text>"} ],
             "personality_traits": [ {"trait": "<Generate a personality description based on the context text>" } ],
@@ -67,6 +59,7 @@ Please follow the precise format in the examples below when generating the agent
           "nationality": "German",
           "country_of_residence": "Germany",
           "occupation": "Architect,
+          "income_band": "upper-middle",
           "occupation_description": "You are an architect. You work at a company called 'Awesome Inc.'. Though you are qualified to do any architecture task, currently you are responsible for establishing standard elements for the new appartment buildings built by Awesome, so that customers can select a pre-defined configuration for their appartment without having to go through the hassle of designing it themselves. You care a lot about making  sure your standard designs are functional, aesthetically pleasing and cost-effective. Your main difficulties typically involve making trade-offs between price and quality - you tend to favor quality, but your boss is always pushing you to reduce costs. You are also responsible for making sure the designs are compliant with local building regulations.",
           "routines": [
               {"routine": "Every morning, you wake up, feed your dog, and go to work."}
@@ -112,6 +105,7 @@ Please follow the precise format in the examples below when generating the agent
           "nationality": "French",
           "country_of_residence": "France",
           "occupation": "Unemployed",
+          "income_band": "low",
           "occupation_description": "You are unemployed. You used to work as a secretary, but you lost your job a year ago. You have been struggling to find a new job ever since. You are currently living off your savings, but they are running out fast. You are very worried about your financial situation, and you are starting to feel desperate. You are also feeling very lonely, as you don't have many friends or family members to support you. You are rather melancholic, and you often feel sad and hopeless.",
           "routines": [
               {"routine": "Every morning, you wake up, have a cup of coffee, and spend the day looking for job offers online."},
@@ -148,29 +142,43 @@ Please follow the precise format in the examples below when generating the agent
           "current_emotions": "I feel sad and hopeless."
         }
 
+## General Context
+The general context is the following. 
+
+{{context}}.
+"""
+
+AGENT_GENERATOR_REQUEST = """
+## Agent Particularities
+{{#agent_particularities}}
+The agent particularities, in turn, are: {{agent_particularities}}.
+
+These are the specific context details that you must consider, together with the general context, when generating the agent.
+{{/agent_particularities}}
+{{^agent_particularities}}
+There are no agent particularities in this case, so just generate an agent based on the general
+context.
+{{/agent_particularities}}
+
 ## Existing agents
 
 In order to allow the generation of globally unique names you must consider the agents already present anywhere in the simulation,
-not only by this generator. Names of these existing agents:
-{{#already_generated_names}}  
-- {{.}}
-{{/already_generated_names}}
-{{^already_generated_names}}
-    (No agents are present in the simulation yet.)
-{{/already_generated_names}}
-
-Remember: NEVER repeat a name for an agent. All agent names MUST be UNIQUE in the whole simulation. Read these existing names carefully before generating 
-new agents.
+not only by this generator.
+{{#population_summary}}
+There are already {{known_names}} named agents in the simulation. Names are checked for uniqueness after generation, but you must
+still avoid these names and frequently used first names and surnames: {{excluded_names}}.
 
 Furthermore, in order to generate agents following the distribution requested or implied in **this** generator's general context or agent particularities, 
-you must consider the demographical and biographical details of agents **you** already produced. These are the following:
-{{#already_generated_minibios}}
-- {{.}}
-{{/already_generated_minibios}}
-{{^already_generated_minibios}}
-No agents generated by this generator yet.
-{{/already_generated_minibios}}
-
-Remember: when producing new agents, you must consider the agents **you** already generated to ensure the sample is representative of the desired population.
+you must consider the demographics of the {{population_size}} agents **you** already produced. Their distribution is the following:
+{{#histograms}}
+- {{dimension}}: {{buckets}}
+{{/histograms}}
+{{/population_summary}}
+{{^population_summary}}
+    (No agents are present in the simulation yet.)
+{{/population_summary}}
+
+Remember: NEVER repeat a name for an agent. All agent names MUST be UNIQUE in the whole simulation. When producing new agents, you must
+adjust their demographics so the sample above converges to the desired population.
 
 """
\ No newline at end of file
@@ -0,0 +1,24 @@
+import chevron
+
+# Helpers for prompts laid out for provider-side prompt caching: providers
+# reuse the longest previously seen prefix of a request, so every prompt is
+# built as a static prefix (system message, identical across calls) followed
+# by a volatile suffix (user message with the per-call data).
+
+
+class PromptTemplate:
+    # A mustache template tokenized once, instead of on every render
+
+    def __init__(self, source):
+        self.source = source
+        self.tokens = list(chevron.tokenizer.tokenize(source))
+
+    def render(self, data):
+        return chevron.render(self.tokens, data)
+
+
+def prefixed_messages(prefix, suffix):
+    return [
+        {"role": "system", "content": prefix},
+        {"role": "user", "content": suffix}
+    ]
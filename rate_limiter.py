@@ -0,0 +1,312 @@
+import asyncio
+import json
+import logging
+import os
+import random
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Client-side pacing for provider calls, shared by every call site in the
+# process. Per model there are
+#
+#   - requests-per-minute and tokens-per-minute token buckets, so bursts are
+#     spread out instead of being rejected with 429s,
+#   - an AIMD concurrency limit: +1 per limit's worth of successful calls,
+#     halved on 429/5xx and cut by 10% when latency rises well above its
+#     running average,
+#
+# and retryable failures (429, 5xx, connection errors) are retried with
+# exponential backoff and full jitter, honouring Retry-After.
+
+DEFAULT_COMPLETION_ESTIMATE = 256
+
+
+class TokenBucket:
+    def __init__(self, per_minute, capacity=None):
+        self.rate = per_minute / 60.0
+        self.capacity = float(capacity or per_minute)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, amount):
+        # Debits amount now and returns how long the caller has to wait
+        # before using it; the balance may go negative to queue callers
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= amount
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def adjust(self, amount):
+        # Corrects an earlier reservation once the real cost is known
+        with self._lock:
+            self.tokens = min(self.capacity, self.tokens - amount)
+
+
+class AdaptiveConcurrency:
+    # Concurrency slots for both threads and coroutines (on any loop), with
+    # an AIMD-controlled limit
+
+    def __init__(self, initial=16, minimum=1, maximum=128, latency_factor=2.0, cooldown=2.0):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.latency_factor = latency_factor
+        self.cooldown = cooldown
+        self.limit = float(max(minimum, min(initial, maximum)))
+        self.in_flight = 0
+        self.latency_avg = None
+        self._last_decrease = 0.0
+        self._cond = threading.Condition()
+        self._async_waiters = []
+
+    def _try_acquire(self):
+        if self.in_flight < int(self.limit):
+            self.in_flight += 1
+            return True
+        return False
+
+    def acquire_sync(self):
+        with self._cond:
+            while not self._try_acquire():
+                self._cond.wait(1.0)
+
+    async def acquire(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            with self._cond:
+                if self._try_acquire():
+                    return
+                future = loop.create_future()
+                self._async_waiters.append((loop, future))
+            try:
+                # The timeout also picks up limit increases nobody signalled
+                await asyncio.wait_for(future, 1.0)
+            except asyncio.TimeoutError:
+                pass
+
+    def release(self):
+        with self._cond:
+            self.in_flight -= 1
+            self._cond.notify_all()
+            waiters, self._async_waiters = self._async_waiters, []
+        for loop, future in waiters:
+            loop.call_soon_threadsafe(_wake, future)
+
+    def on_success(self, latency):
+        with self._cond:
+            previous = self.latency_avg
+            self.latency_avg = latency if previous is None else 0.9 * previous + 0.1 * latency
+            if previous is not None and latency > self.latency_factor * previous:
+                self._decrease(0.9)
+            else:
+                self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+
+    def on_overload(self):
+        with self._cond:
+            self._decrease(0.5)
+
+    def _decrease(self, factor):
+        # One cut per cooldown, so a burst of failures from the same window
+        # doesn't collapse the limit to the minimum
+        now = time.monotonic()
+        if now - self._last_decrease < self.cooldown:
+            return
+        self._last_decrease = now
+        self.limit = max(self.minimum, self.limit * factor)
+        logger.info(f"Lowered LLM concurrency limit to {int(self.limit)}")
+
+
+def _wake(future):
+    if not future.done():
+        future.set_result(None)
+
+
+class ModelLimiter:
+    def __init__(self, rpm, tpm, concurrency):
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.concurrency = concurrency
+
+    def reserve(self, estimate):
+        return max(self.requests.reserve(1), self.tokens.reserve(estimate))
+
+
+def estimate_tokens(messages, params):
+    prompt = sum(len(str(message.get("content") or "")) for message in messages) // 4
+    return prompt + int(params.get("max_tokens") or DEFAULT_COMPLETION_ESTIMATE)
+
+
+def is_retryable(error):
+    status = getattr(error, "status_code", None)
+    if status is not None:
+        return status == 429 or status >= 500
+    # Connection and timeout errors from the openai/httpx clients carry no status
+    return type(error).__name__ in ("APIConnectionError", "APITimeoutError", "ConnectError", "ReadTimeout")
+
+
+class RateLimiter:
+    def __init__(self, rpm=500, tpm=150000, per_model=None, concurrency=None, max_retries=5,
+                 base_delay=0.5, max_delay=30.0, on_retry=None):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.per_model = per_model or {}
+        self.concurrency = concurrency or {}
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        # on_retry(model, error) is called before each retry, e.g. for metrics
+        self.on_retry = on_retry
+        self._models = {}
+        self._lock = threading.Lock()
+
+    def for_model(self, model):
+        with self._lock:
+            limiter = self._models.get(model)
+            if limiter is None:
+                limits = self.per_model.get(model, {})
+                limiter = self._models[model] = ModelLimiter(
+                    limits.get("rpm", self.rpm),
+                    limits.get("tpm", self.tpm),
+                    AdaptiveConcurrency(**dict(self.concurrency, **limits.get("concurrency", {})))
+                )
+            return limiter
+
+    def retry_delay(self, error, attempt):
+        # None when the error should not be retried
+        if attempt >= self.max_retries or not is_retryable(error):
+            return None
+        response = getattr(error, "response", None)
+        retry_after = response.headers.get("retry-after") if response is not None else None
+        try:
+            if retry_after:
+                return min(self.max_delay, float(retry_after))
+        except ValueError:
+            pass
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def _failed(self, model, error, attempt):
+        limiter = self.for_model(model)
+        if is_retryable(error):
+            limiter.concurrency.on_overload()
+        delay = self.retry_delay(error, attempt)
+        if delay is not None:
+            logger.warning(f"LLM call to {model} failed ({error}); retry {attempt + 1} in {delay:.2f}s")
+            if self.on_retry is not None:
+                self.on_retry(model, error)
+        return delay
+
+    def _succeeded(self, model, estimate, started, result):
+        limiter = self.for_model(model)
+        limiter.concurrency.on_success(time.monotonic() - started)
+        used = (result.prompt_tokens or 0) + (result.completion_tokens or 0)
+        if used:
+            limiter.tokens.adjust(used - estimate)
+
+    def call_sync(self, model, estimate, fn):
+        limiter = self.for_model(model)
+        attempt = 0
+        while True:
+            wait = limiter.reserve(estimate)
+            if wait:
+                time.sleep(wait)
+            limiter.concurrency.acquire_sync()
+            started = time.monotonic()
+            try:
+                result = fn()
+            except Exception as e:
+                delay = self._failed(model, e, attempt)
+                if delay is None:
+                    raise
+            else:
+                self._succeeded(model, estimate, started, result)
+                return result
+            finally:
+                limiter.concurrency.release()
+            time.sleep(delay)
+            attempt += 1
+
+    async def call(self, model, estimate, factory):
+        # factory() returns a fresh coroutine per attempt
+        limiter = self.for_model(model)
+        attempt = 0
+        while True:
+            wait = limiter.reserve(estimate)
+            if wait:
+                await asyncio.sleep(wait)
+            await limiter.concurrency.acquire()
+            started = time.monotonic()
+            try:
+                result = await factory()
+            except Exception as e:
+                delay = self._failed(model, e, attempt)
+                if delay is None:
+                    raise
+            else:
+                self._succeeded(model, estimate, started, result)
+                return result
+            finally:
+                limiter.concurrency.release()
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def open_stream(self, model, estimate, factory):
+        # Like call(), but the concurrency slot stays taken until the caller
+        # passes the returned handle to close_stream() after consuming it
+        limiter = self.for_model(model)
+        attempt = 0
+        while True:
+            wait = limiter.reserve(estimate)
+            if wait:
+                await asyncio.sleep(wait)
+            await limiter.concurrency.acquire()
+            started = time.monotonic()
+            try:
+                return await factory(), started
+            except Exception as e:
+                limiter.concurrency.release()
+                delay = self._failed(model, e, attempt)
+                if delay is None:
+                    raise
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    def close_stream(self, model, estimate, started, result=None):
+        limiter = self.for_model(model)
+        limiter.concurrency.release()
+        if result is not None:
+            self._succeeded(model, estimate, started, result)
+
+    def stats(self):
+        with self._lock:
+            models = dict(self._models)
+        return {
+            model: {
+                "concurrency_limit": int(limiter.concurrency.limit),
+                "in_flight": limiter.concurrency.in_flight,
+                "latency_avg": round(limiter.concurrency.latency_avg, 3) if limiter.concurrency.latency_avg else None,
+                "request_tokens": round(limiter.requests.tokens, 1),
+                "token_tokens": round(limiter.tokens.tokens, 1)
+            }
+            for model, limiter in models.items()
+        }
+
+
+def build_rate_limiter(on_retry=None):
+    # LLM_RATE_LIMITS holds per-model overrides, e.g.
+    #   {"gpt-4o": {"rpm": 5000, "tpm": 800000, "concurrency": {"maximum": 256}}}
+    return RateLimiter(
+        rpm=float(os.getenv("LLM_RPM", 500)),
+        tpm=float(os.getenv("LLM_TPM", 150000)),
+        per_model=json.loads(os.getenv("LLM_RATE_LIMITS", "{}")),
+        concurrency={
+            "initial": int(os.getenv("LLM_CONCURRENCY_INITIAL", 16)),
+            "minimum": int(os.getenv("LLM_CONCURRENCY_MIN", 1)),
+            "maximum": int(os.getenv("LLM_CONCURRENCY_MAX", 128))
+        },
+        max_retries=int(os.getenv("LLM_MAX_RETRIES", 5)),
+        on_retry=on_retry
+    )
@@ -0,0 +1,91 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+
+def prompt_hash(*parts):
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update((part or "").encode("utf-8"))
+        digest.update(b"\x00")
+    return digest.hexdigest()[:16]
+
+
+class _Entry:
+    __slots__ = ("values", "fills", "expires_at", "cursor")
+
+    def __init__(self, expires_at):
+        self.values = []
+        self.fills = 0
+        self.expires_at = expires_at
+        self.cursor = 0
+
+
+class RoutingDecisionCache:
+    # LRU + TTL cache for routing decisions keyed on (stage, prompt hash).
+    # With pool_size > 1 each key collects up to pool_size distinct answers
+    # from the LLM and then rotates through them, so callers still see some
+    # variety without every request reaching the model.
+
+    def __init__(self, maxsize=256, ttl=600, pool_size=1):
+        self.maxsize = max(1, int(maxsize))
+        self.ttl = float(ttl)
+        self.pool_size = max(1, int(pool_size))
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry.expires_at <= time.monotonic():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+
+            # Keep filling the sample pool before serving from it. Duplicate
+            # answers still count as a fill so a stable model can't starve it.
+            if entry.fills < self.pool_size:
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            value = entry.values[entry.cursor % len(entry.values)]
+            entry.cursor += 1
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry.expires_at <= time.monotonic():
+                entry = _Entry(time.monotonic() + self.ttl)
+                self._entries[key] = entry
+
+            entry.fills += 1
+            if value not in entry.values and len(entry.values) < self.pool_size:
+                entry.values.append(value)
+
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 4) if total else 0.0,
+                "maxsize": self.maxsize,
+                "ttl": self.ttl,
+                "pool_size": self.pool_size
+            }
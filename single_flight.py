@@ -0,0 +1,115 @@
+import asyncio
+import re
+import threading
+
+from llm_backend import request_key
+
+# Request coalescing ("single flight"): while a call for a key is in flight,
+# identical calls wait for it and share its result (or its exception) instead
+# of issuing their own. Nothing is kept once the call finishes; caching
+# finished results is the job of routing_cache and friends.
+
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_prompt(text):
+    # Indentation and line breaks from the f-string templates do not change
+    # the meaning of a prompt, so they do not change its key either
+    return _WHITESPACE.sub(" ", text or "").strip()
+
+
+def flight_key(messages, model, **params):
+    normalized = [dict(message, content=normalize_prompt(message["content"])) for message in messages]
+    return request_key(normalized, model, params)
+
+
+class _Flight:
+    __slots__ = ("done", "result", "error", "waiters")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+class SingleFlight:
+    # For synchronous callers, e.g. Flask request threads in acc_3js_v1
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights = {}
+        self.calls = 0
+        self.coalesced = 0
+
+    def do(self, key, fn):
+        # Returns (result, shared); shared is True when another caller made the call
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+                self.calls += 1
+            else:
+                flight.waiters += 1
+                self.coalesced += 1
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result, True
+
+        try:
+            flight.result = fn()
+            return flight.result, False
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                self._flights.pop(key, None)
+            flight.done.set()
+
+    def stats(self):
+        with self._lock:
+            return {"calls": self.calls, "coalesced": self.coalesced, "in_flight": len(self._flights)}
+
+
+class AsyncSingleFlight:
+    # For coroutines on one event loop, e.g. the shared loop in async_runtime
+
+    def __init__(self):
+        self._flights = {}
+        self.calls = 0
+        self.coalesced = 0
+
+    async def do(self, key, factory):
+        # factory() returns a fresh coroutine; it is only called once per flight
+        loop = asyncio.get_running_loop()
+        task = self._flights.get(key)
+        if task is not None and task.get_loop() is not loop:
+            # Tasks cannot be awaited across loops; call without coalescing
+            return await factory(), False
+
+        shared = task is not None
+        if shared:
+            self.coalesced += 1
+        else:
+            # The call runs in its own task, owned by no caller, so a
+            # cancelled caller (e.g. a client that went away) only stops
+            # waiting; the others still get the result
+            task = loop.create_task(factory())
+            self._flights[key] = task
+            self.calls += 1
+            task.add_done_callback(lambda done: self._finished(key, done))
+        return await asyncio.shield(task), shared
+
+    def _finished(self, key, task):
+        if self._flights.get(key) is task:
+            del self._flights[key]
+        # Mark the exception retrieved when nobody was left waiting
+        if not task.cancelled():
+            task.exception()
+
+    def stats(self):
+        return {"calls": self.calls, "coalesced": self.coalesced, "in_flight": len(self._flights)}
@@ -1,15 +1,31 @@
-from flask import Flask, render_template, jsonify, request, send_from_directory
+from flask import Flask, render_template, jsonify, request, send_from_directory, Response
 import logging
 import os
 import sys
 from dotenv import load_dotenv
-from openai import OpenAI
 from datetime import datetime
 import random
 import asyncio
+import uuid
+import time
+import json
+import threading
+from collections import OrderedDict
+from lead_batch import LeadBatchRunner
+from funnel_simulator import simulate as simulate_funnel
+from funnel_analytics import FunnelAggregator
+from async_runtime import run_async, iterate_async
+from workflow_engine import CompiledWorkflow
+from lead_catalog import CLIENTS, STREAMS, EMPLOYEES
+from conversation_memory import ConversationMemory
+from lead_store import LeadStore, LeadBusyError, LeadConflictError
+from llm_backend import LLMResult, get_backend
+from model_policy import get_policy
+from single_flight import AsyncSingleFlight, flight_key
+from prompt_builder import prefixed_messages
+from llm_metrics import observe_llm_call, record_coalesced, render_prometheus, PROMETHEUS_CONTENT_TYPE
 
 load_dotenv()
-client = OpenAI(api_key=os.getenv("SECRET_KEY"))
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -17,88 +33,102 @@ logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
 
-# Lead management workflow definition
-WORKFLOW = [
-    {
-        "stage": "Begun Desk",
-        "prompt": "How should we process this new incoming lead?",
-        "next_stage_prompt": "Based on the lead details, what's the next appropriate step?",
-        "color": "#2196F3",
-        "possible_next": ["Assign Desk"]
-    },
-    {
-        "stage": "Assign Desk",
-        "prompt": "Which employee should be assigned to this lead?",
-        "next_stage_prompt": "Once the lead is assigned, what's the next step?",
-        "color": "#00BCD4",
-        "possible_next": ["Calling Desk", "Ended Desk"]
-    },
-    {
-        "stage": "Calling Desk",
-        "prompt": "How should we approach the call with this lead?",
-        "next_stage_prompt": "Based on the call outcome, where should this lead go?",
-        "color": "#FFEB3B",
-        "possible_next": ["Meeting Desk", "Assign Desk", "Ended Desk"]
-    },
-    {
-        "stage": "Meeting Desk",
-        "prompt": "What's the status of the meeting with this lead?",
-        "next_stage_prompt": "Based on the meeting outcome, what's the next step?",
-        "color": "#FF9800",
-        "possible_next": ["Onboarding Desk", "Ended Desk"]
-    },
-    {
-        "stage": "Onboarding Desk",
-        "prompt": "What onboarding steps are needed for this closed deal?",
-        "next_stage_prompt": "Based on the onboarding status, where should this lead go?",
-        "color": "#4CAF50",
-        "possible_next": ["Ended Desk"]
-    },
-    {
-        "stage": "Ended Desk",
-        "prompt": "What is the final status of this lead?",
-        "next_stage_prompt": None,
-        "color": "#F44336",
-        "possible_next": []
-    }
-]
-
-# Client products/services for which leads are being collected
-CLIENTS = [
-    {
-        "name": "TechCloud Solutions",
-        "product": "Cloud Storage Service",
-        "target_market": "Small to Medium Businesses",
-        "price_range": "$50-500/month"
-    },
-    {
-        "name": "SecureNet",
-        "product": "Cybersecurity Suite",
-        "target_market": "Enterprise",
-        "price_range": "$1000-5000/month"
-    },
-    {
-        "name": "DataFlow Analytics",
-        "product": "Business Intelligence Tools",
-        "target_market": "Mid-market Companies",
-        "price_range": "$200-2000/month"
-    }
-]
-
-# Social media platforms (streams) where leads are collected
-STREAMS = ["LinkedIn", "Twitter", "Facebook", "Industry Forums", "Email Campaigns"]
-
-# Sample employees who can be assigned to leads
-EMPLOYEES = [
-    {"name": "Alice Smith", "expertise": ["Cloud Services", "Data Analytics"]},
-    {"name": "Bob Johnson", "expertise": ["Cybersecurity", "Enterprise Solutions"]},
-    {"name": "Carol Williams", "expertise": ["Business Intelligence", "Consulting"]}
-]
+# Lead management workflow definition, compiled from workflows/lead_management.json
+WORKFLOW_ENGINE = (
+    CompiledWorkflow.from_file(os.environ["LEAD_WORKFLOW_PATH"])
+    if os.getenv("LEAD_WORKFLOW_PATH")
+    else CompiledWorkflow.load("lead_management")
+)
+WORKFLOW = WORKFLOW_ENGINE.stages
+
+# Models come from the per-stage policy in workflows/model_policy.json: only
+# Calling Desk and Meeting Desk agent turns use the large tier. TROUPE_MODEL
+# pins every agent, lead and summary turn to one model instead
+LLM_MODEL = os.getenv("TROUPE_MODEL")
+
+# Leads in the same stage and status produce identical agent prompts; while
+# one of those is in flight the others wait for it instead of calling again
+llm_flights = AsyncSingleFlight()
+
+# Prompts are (static prefix, volatile suffix) message pairs from
+# prompt_builder.prefixed_messages, so the provider can cache the prefix
+
+async def complete(messages, model=None, stage=None, role="agent"):
+    async with get_policy().use("troupe_marketing", stage, role, model=model or LLM_MODEL) as choice:
+        params = choice.params()
+
+        async def call_llm():
+            async with observe_llm_call("troupe_marketing", stage, choice.model, role) as call:
+                result = await get_backend().complete(messages, choice.model, **params)
+                call.usage(result.prompt_tokens, result.completion_tokens, result.cached_tokens)
+            return result
+
+        result, shared = await llm_flights.do(flight_key(messages, choice.model, **params), call_llm)
+        if shared:
+            record_coalesced("troupe_marketing", stage, choice.model, role)
+        else:
+            choice.usage(result.prompt_tokens, result.completion_tokens)
+    return result.text
+
+async def complete_stream(messages, model=None, stage=None, role="agent"):
+    # Yields content deltas as the model produces them. Shares llm_flights
+    # with complete(): the caller that starts a call streams it, callers that
+    # join one in flight get the whole text as a single delta once it is done
+    async with get_policy().use("troupe_marketing", stage, role, model=model or LLM_MODEL) as choice:
+        params = choice.params()
+        tokens = asyncio.Queue()
+
+        async def call_llm():
+            # Only runs for the caller that starts the flight
+            async with observe_llm_call("troupe_marketing", stage, choice.model, role) as call:
+                parts = []
+                async for token in get_backend().stream(messages, choice.model, usage=call.usage, **params):
+                    parts.append(token)
+                    tokens.put_nowait(token)
+            return LLMResult("".join(parts), choice.model, call.prompt_tokens, call.completion_tokens,
+                             call.cached_tokens)
+
+        flight = asyncio.ensure_future(llm_flights.do(flight_key(messages, choice.model, **params), call_llm))
+        try:
+            while not (flight.done() and tokens.empty()):
+                getter = asyncio.ensure_future(tokens.get())
+                await asyncio.wait({getter, flight}, return_when=asyncio.FIRST_COMPLETED)
+                if getter.done():
+                    yield getter.result()
+                else:
+                    getter.cancel()
+            result, shared = flight.result()
+        finally:
+            # Stops waiting only; the shared call carries on for other callers
+            if not flight.done():
+                flight.cancel()
+        if shared:
+            record_coalesced("troupe_marketing", stage, choice.model, role)
+            yield result.text
+        else:
+            choice.usage(result.prompt_tokens, result.completion_tokens)
+
+SUMMARY_PREFIX = """
+        You maintain a running summary of a sales conversation between a lead and lead management agents.
+        Rewrite the summary to include the new turns. Keep facts, commitments, objections and the lead's sentiment.
+        Respond with the summary only, in at most 120 words.
+        """
+
+async def summarize_conversation(summary, turns):
+    suffix = f"""
+        Current summary:
+        {summary or "(empty)"}
+        
+        New turns to fold in:
+        {chr(10).join(turns)}
+        """
+    return await complete(prefixed_messages(SUMMARY_PREFIX, suffix), stage="summary", role="memory")
 
 class Lead:
-    def __init__(self, source_stream):
-        self.client = random.choice(CLIENTS)
+    def __init__(self, source_stream, client=None):
+        self.client = client or random.choice(CLIENTS)
         self.stream = source_stream
+        self.created_at = time.time()
         self.status = {
             "assigned_employee": None,
             "meeting_scheduled": False,
@@ -107,83 +137,369 @@ class Lead:
             "onboarding_status": None  # can be "complete", "failed", or None
         }
         self.current_stage = "Begun Desk"
-        self.conversation_history = []
+        # Store version this object was loaded at; not part of the record
+        self.version = None
+        self._prompt_prefix = None
+        self.memory = ConversationMemory(
+            summarize=summarize_conversation,
+            max_recent_turns=int(os.getenv("MEMORY_RECENT_TURNS", 6)),
+            token_budget=int(os.getenv("MEMORY_TOKEN_BUDGET", 1200))
+        )
 
-    async def respond(self, message):
-        prompt = f"""
+    @property
+    def conversation_history(self):
+        return self.memory.turns
+
+    def to_record(self):
+        return {
+            "client": self.client,
+            "stream": self.stream,
+            "status": self.status,
+            "current_stage": self.current_stage,
+            "memory": self.memory.to_dict(),
+            "created_at": self.created_at
+        }
+
+    @classmethod
+    def from_record(cls, record):
+        lead = cls(record["stream"], client=record["client"])
+        lead.status = record["status"]
+        lead.current_stage = record["current_stage"]
+        lead.created_at = record.get("created_at", lead.created_at)
+        lead.memory.load_dict(record.get("memory", {}))
+        return lead
+
+    @property
+    def prompt_prefix(self):
+        # Fixed for the lifetime of the lead
+        if self._prompt_prefix is None:
+            self._prompt_prefix = f"""
         You are a lead interested in {self.client['product']} from {self.client['name']}.
         You were found through {self.stream}.
+        Respond naturally as this lead, considering your interest in the product and current stage in the process.
+        """
+        return self._prompt_prefix
+
+    def build_prompt(self, message, history):
+        return prefixed_messages(self.prompt_prefix, f"""
         Current stage: {self.current_stage}
         Status: {self.status}
         
         Previous conversation:
-        {self.conversation_history}
+        {history}
         
         Current message: {message}
-        
-        Respond naturally as this lead, considering your interest in the product and current stage in the process.
-        """
-        
-        response = client.chat.completions.create(
-            model="gpt-4",
-            messages=[{"role": "system", "content": prompt}]
-        )
-        
-        self.conversation_history.append(f"Lead: {response.choices[0].message.content}")
-        return response.choices[0].message.content
+        """)
+
+    async def respond(self, message):
+        messages = self.build_prompt(message, await self.memory.render())
+        content = await complete(messages, stage=self.current_stage, role="lead")
+        self.memory.add("Lead", content)
+        return content
+
+    async def respond_stream(self, message):
+        messages = self.build_prompt(message, await self.memory.render())
+        parts = []
+        async for token in complete_stream(messages, stage=self.current_stage, role="lead"):
+            parts.append(token)
+            yield token
+        self.memory.add("Lead", "".join(parts))
 
 class LeadAgent:
     def __init__(self, stage):
         self.stage = stage
-        self.workflow = next(w for w in WORKFLOW if w["stage"] == stage)
-
-    async def respond(self, message, lead):
-        prompt = f"""
+        self.workflow = WORKFLOW_ENGINE.stage(stage)
+        # Same for every lead at this desk
+        self.prompt_prefix = f"""
         You are a lead management agent at the {self.stage}.
+        Your task: {self.workflow['prompt']}
+        Respond professionally as a lead management agent, following the workflow guidelines for your desk.
+        """
+
+    def build_prompt(self, message, lead):
+        return prefixed_messages(self.prompt_prefix, f"""
         Current lead details:
         - Interested in: {lead.client['product']}
         - Source: {lead.stream}
         - Status: {lead.status}
         
-        Your task: {self.workflow['prompt']}
-        
         Current message: {message}
-        
-        Respond professionally as a lead management agent, following the workflow guidelines for your desk.
-        """
-        
-        response = client.chat.completions.create(
-            model="gpt-4",
-            messages=[{"role": "system", "content": prompt}]
-        )
-        
-        return response.choices[0].message.content
+        """)
+
+    async def respond(self, message, lead):
+        return await complete(self.build_prompt(message, lead), stage=self.stage)
+
+    async def respond_stream(self, message, lead):
+        async for token in complete_stream(self.build_prompt(message, lead), stage=self.stage):
+            yield token
 
 class LeadManagementSystem:
-    def __init__(self):
-        self.leads = {}
+    def __init__(self, store=None, cache_size=10000, lease_ttl=None):
+        self.store = store or LeadStore(
+            path=os.getenv("LEAD_DB_PATH", "leads.db"),
+            batch_size=int(os.getenv("LEAD_DB_BATCH_SIZE", 200)),
+            flush_interval=float(os.getenv("LEAD_DB_FLUSH_INTERVAL", 1.0))
+        )
+        # Hot leads stay in memory; everything else is loaded from the store on demand
+        self.leads = OrderedDict()
+        self.cache_size = cache_size
+        # Request threads and store calls moved off the loop share the cache
+        self._cache_lock = threading.RLock()
+        # Longest a step may hold a lead before another worker can take it over
+        self.lease_ttl = lease_ttl or float(os.getenv("LEAD_LEASE_TTL", 120))
         self.agents = {stage["stage"]: LeadAgent(stage["stage"]) for stage in WORKFLOW}
-        
-    async def create_lead(self, stream=None):
+        self.funnel = FunnelAggregator(self.store, WORKFLOW_ENGINE,
+                                       bucket_seconds=int(os.getenv("FUNNEL_BUCKET_SECONDS", 3600)))
+        # Speculative prefetch (opt-in, spends tokens on steps that may never be
+        # requested): once a step is saved, the next desk's agent turn is started
+        # in the background, keyed by the lead version it was built from. The
+        # next step uses it only if the lead is still at that version
+        self.speculative = os.getenv("SPECULATIVE_PREFETCH", "0") == "1"
+        self.prefetch_limit = int(os.getenv("SPECULATIVE_PREFETCH_LIMIT", 1000))
+        self.prefetched = OrderedDict()
+
+    def _remember(self, lead_id, lead):
+        with self._cache_lock:
+            self.leads[lead_id] = lead
+            self.leads.move_to_end(lead_id)
+            while len(self.leads) > self.cache_size:
+                self.leads.popitem(last=False)
+
+    def _forget(self, lead_id):
+        with self._cache_lock:
+            self.leads.pop(lead_id, None)
+
+    def get_lead(self, lead_id):
+        # The cached copy is only used while it matches the stored version;
+        # another worker may have advanced the lead since. Blocking; coroutines
+        # call it through asyncio.to_thread
+        with self._cache_lock:
+            lead = self.leads.get(lead_id)
+        if lead is None or lead.version != self.store.get_version(lead_id):
+            record, version = self.store.get_lead(lead_id)
+            if record is None:
+                self._forget(lead_id)
+                return None
+            lead = Lead.from_record(record)
+            lead.version = version
+        self._remember(lead_id, lead)
+        return lead
+
+    def save(self, lead_id, lead):
+        try:
+            lead.version = self.store.save_lead(lead_id, lead.to_record(), expected_version=lead.version)
+        except LeadConflictError:
+            # The in-memory copy holds changes that lost the race; drop it
+            self._forget(lead_id)
+            raise
+
+    # Store access blocks (up to the store's busy timeout while another worker
+    # holds the SQLite write lock, and on the connection lock held meanwhile),
+    # so coroutines run the helpers below through asyncio.to_thread and the
+    # shared loop keeps serving other streams
+
+    def _persist_turn(self, lead_id, lead, stage, role, content):
+        self.save(lead_id, lead)
+        self.store.append_turn(lead_id, stage, role, content)
+
+    def _persist_step(self, lead_id, lead, stage, agent_message, previous_status):
+        self._persist_turn(lead_id, lead, stage, "agent", agent_message)
+        self.funnel.record_step(lead, stage, previous_status)
+
+    def _persist_new(self, lead_id, lead):
+        lead.version = self.store.save_lead(lead_id, lead.to_record())
+        self._remember(lead_id, lead)
+        self.funnel.record_created(lead)
+
+    def acquire(self, lead_id):
+        # Per-lead lease so a step runs once even across worker processes
+        owner = f"{os.getpid()}:{uuid.uuid4().hex[:12]}"
+        if not self.store.acquire_lease(lead_id, owner, self.lease_ttl):
+            raise LeadBusyError(f"Lead {lead_id} is being processed by another request")
+        return owner
+
+    def release(self, lead_id, owner):
+        self.store.release_lease(lead_id, owner)
+
+    def renew(self, lead_id, owner):
+        # Re-acquiring with the same owner extends the lease
+        if not self.store.acquire_lease(lead_id, owner, self.lease_ttl):
+            raise LeadBusyError(f"Lost the lease on lead {lead_id}")
+
+    async def create_lead(self, stream=None, prefetch=False):
+        # prefetch: start the first desk's agent turn speculatively; only the
+        # interactive /create_lead route asks for it
         if stream is None:
             stream = random.choice(STREAMS)
             
         lead = Lead(stream)
-        lead_id = f"LEAD_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
-        self.leads[lead_id] = lead
+        # Timestamp prefix keeps IDs roughly sortable; the uuid makes them collision-free
+        lead_id = f"LEAD_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex}"
+        await asyncio.to_thread(self._persist_new, lead_id, lead)
+        if prefetch:
+            self._prefetch(lead_id, lead)
         return lead_id, lead
 
-    async def process_lead(self, lead_id):
-        lead = self.leads[lead_id]
-        current_agent = self.agents[lead.current_stage]
-        
-        # Process the lead based on current stage
-        conversation = []
-        next_stage = None
-        
-        # Generate appropriate response based on stage
-        agent_message = await current_agent.respond("", lead)
-        conversation.append({"role": "agent", "content": agent_message})
+    def _prefetch(self, lead_id, lead):
+        # Runs on the shared loop; the task outlives the request that started it
+        if not self.speculative:
+            return
+        agent = self.agents[lead.current_stage]
+        # The prompt is built now, from the state that was just saved
+        task = asyncio.get_running_loop().create_task(
+            complete(agent.build_prompt("", lead), stage=agent.stage)
+        )
+        # Stale prefetches are dropped rather than cancelled: identical prompts
+        # from other leads may be coalesced onto the same call
+        task.add_done_callback(_discard_result)
+        self.prefetched[lead_id] = (lead.version, lead.current_stage, task)
+        self.prefetched.move_to_end(lead_id)
+        while len(self.prefetched) > self.prefetch_limit:
+            self.prefetched.popitem(last=False)
+
+    async def _take_prefetched(self, lead_id, lead):
+        # The agent message prefetched for exactly this lead version, or None
+        entry = self.prefetched.pop(lead_id, None)
+        if entry is None:
+            return None
+        version, stage, task = entry
+        if version != lead.version or stage != lead.current_stage:
+            logger.debug(f"Discarding stale prefetch for {lead_id} (version {version}, now {lead.version})")
+            return None
+        try:
+            # shield: cancelling this step must not cancel the prefetch, so the
+            # two kinds of cancellation can be told apart below
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if not task.cancelled():
+                raise
+            # The prefetch itself was cancelled; that is a miss
+            logger.warning(f"Prefetched response for {lead_id} was cancelled, generating again")
+            return None
+        except Exception as e:
+            logger.warning(f"Prefetched response for {lead_id} failed, generating again: {e}")
+            return None
+
+    async def _load_for_processing(self, lead_id):
+        lead = await asyncio.to_thread(self.get_lead, lead_id)
+        if lead is None:
+            raise KeyError(lead_id)
+        return lead
+
+    async def process_lead(self, lead_id, prefetch=True):
+        # prefetch starts the next step's agent message once this one is
+        # saved, for interactive callers who will likely ask for it soon
+        owner = await asyncio.to_thread(self.acquire, lead_id)
+        try:
+            lead = await self._load_for_processing(lead_id)
+            current_agent = self.agents[lead.current_stage]
+
+            # Generate appropriate response based on stage
+            agent_message = await self._take_prefetched(lead_id, lead)
+            prefetched = agent_message is not None
+            if not prefetched:
+                agent_message = await current_agent.respond("", lead)
+            result = await self.complete_step(lead_id, lead, current_agent, agent_message)
+            result["prefetched"] = prefetched
+            if prefetch and result["next_stage"]:
+                self._prefetch(lead_id, lead)
+            return result
+        finally:
+            await asyncio.to_thread(self.release, lead_id, owner)
+
+    async def process_lead_stream(self, lead_id):
+        # Same step as process_lead, but yields ("token", text) events while the
+        # agent message is generated and a final ("done", result) event
+        owner = await asyncio.to_thread(self.acquire, lead_id)
+        try:
+            lead = await self._load_for_processing(lead_id)
+            current_agent = self.agents[lead.current_stage]
+
+            agent_message = await self._take_prefetched(lead_id, lead)
+            prefetched = agent_message is not None
+            if prefetched:
+                yield "token", agent_message
+            else:
+                parts = []
+                async for token in current_agent.respond_stream("", lead):
+                    parts.append(token)
+                    yield "token", token
+                agent_message = "".join(parts)
+
+            result = await self.complete_step(lead_id, lead, current_agent, agent_message)
+            result["prefetched"] = prefetched
+            if result["next_stage"]:
+                self._prefetch(lead_id, lead)
+            yield "done", result
+        finally:
+            await asyncio.to_thread(self.release, lead_id, owner)
+
+    async def run_lead(self, lead_id, max_steps=None):
+        # Runs the whole lifecycle: at every desk the agent speaks, the step is
+        # committed and the lead replies. The lead's reply and the next desk's
+        # agent turn both only depend on the committed step, so they are
+        # generated concurrently; the only sequential LLM calls left are one
+        # per desk (plus the lead reply when it is the slower of the two).
+        # Yields ("token", {role, stage, content}) while turns are generated,
+        # ("turn", {role, stage, content}) when one is complete, ("step",
+        # result) per committed step and a final ("done", summary)
+        owner = await asyncio.to_thread(self.acquire, lead_id)
+        max_steps = max_steps or int(os.getenv("RUN_LEAD_MAX_STEPS", 20))
+        started = time.perf_counter()
+        queue = asyncio.Queue()
+        try:
+            lead = await self._load_for_processing(lead_id)
+            agent = self.agents[lead.current_stage]
+            path = [lead.current_stage]
+
+            agent_message = await self._take_prefetched(lead_id, lead)
+            if agent_message is not None:
+                yield "turn", {"role": "agent", "stage": agent.stage, "content": agent_message}
+            else:
+                results = []
+                async for event in _concurrently(queue, results, _stream_turn(
+                        queue, "agent", agent.stage, agent.respond_stream("", lead))):
+                    yield event
+                agent_message, = results
+
+            steps = 0
+            while True:
+                stage = lead.current_stage
+                step = await self.complete_step(lead_id, lead, agent, agent_message)
+                steps += 1
+                yield "step", step
+                if not step["next_stage"] or steps >= max_steps:
+                    break
+                path.append(step["next_stage"])
+                await asyncio.to_thread(self.renew, lead_id, owner)
+
+                agent = self.agents[lead.current_stage]
+                results = []
+                async for event in _concurrently(
+                        queue, results,
+                        _stream_turn(queue, "lead", stage, lead.respond_stream(agent_message)),
+                        _stream_turn(queue, "agent", agent.stage, agent.respond_stream("", lead))):
+                    yield event
+                lead_reply, agent_message = results
+                # The reply answers the desk that just spoke
+                await asyncio.to_thread(self._persist_turn, lead_id, lead, stage, "lead", lead_reply)
+
+            yield "done", {
+                "lead_id": lead_id,
+                "path": path,
+                "steps": steps,
+                "finished": not step["next_stage"],
+                "status": lead.status,
+                "elapsed_seconds": round(time.perf_counter() - started, 3)
+            }
+        finally:
+            await asyncio.to_thread(self.release, lead_id, owner)
+
+    async def complete_step(self, lead_id, lead, current_agent, agent_message):
+        stage = lead.current_stage
+        previous_status = dict(lead.status)
+        conversation = [{"role": "agent", "content": agent_message}]
+        lead.memory.add(f"Agent ({stage})", agent_message)
         
         # Update lead status based on stage
         if lead.current_stage == "Assign Desk" and not lead.status["assigned_employee"]:
@@ -199,30 +515,64 @@ class LeadManagementSystem:
         next_stage = await self.determine_next_stage(lead, current_agent)
         if next_stage:
             lead.current_stage = next_stage
-            
+
+        # Raises LeadConflictError if the lead advanced elsewhere meanwhile
+        await asyncio.to_thread(self._persist_step, lead_id, lead, stage, agent_message, previous_status)
+
         return {
             "conversation": conversation,
             "next_stage": next_stage,
-            "status": lead.status
+            "status": lead.status,
+            "memory": lead.memory.token_counts()
         }
 
     async def determine_next_stage(self, lead, current_agent):
-        # Logic for determining next stage based on lead status
-        if lead.current_stage == "Begun Desk":
-            return "Assign Desk"
-        elif lead.current_stage == "Assign Desk":
-            return "Calling Desk" if lead.status["assigned_employee"] else "Ended Desk"
-        elif lead.current_stage == "Calling Desk":
-            return "Meeting Desk" if not lead.status["meeting_completed"] else "Assign Desk"
-        elif lead.current_stage == "Meeting Desk":
-            if lead.status["deal_status"] == "closed":
-                return "Onboarding Desk"
-            else:
-                return "Ended Desk"
-        elif lead.current_stage == "Onboarding Desk":
-            return "Ended Desk"
-        return None
+        # Transition rules are table-driven from the workflow definition
+        return WORKFLOW_ENGINE.next_stage(lead.current_stage, lead.status)
+
+async def _stream_turn(queue, role, stage, tokens):
+    # Forwards a turn's tokens to queue as events and returns the whole turn
+    parts = []
+    async for token in tokens:
+        parts.append(token)
+        await queue.put(("token", {"role": role, "stage": stage, "content": token}))
+    content = "".join(parts)
+    await queue.put(("turn", {"role": role, "stage": stage, "content": content}))
+    return content
+
+async def _concurrently(queue, results, *turns):
+    # Runs turns together, yielding the events they queue as they arrive;
+    # their return values are appended to results in order
+    tasks = [asyncio.ensure_future(turn) for turn in turns]
+    work = asyncio.gather(*tasks)
+    try:
+        while True:
+            getter = asyncio.ensure_future(queue.get())
+            await asyncio.wait({getter, work}, return_when=asyncio.FIRST_COMPLETED)
+            if not getter.done():
+                getter.cancel()
+                break
+            yield getter.result()
+        while not queue.empty():
+            yield queue.get_nowait()
+        results.extend(work.result())
+    finally:
+        # One turn failed or the client went away: stop the others before the
+        # caller releases the lead, so none of them touches it afterwards
+        pending = [task for task in tasks if not task.done()]
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+
+def _discard_result(task):
+    # Retrieve the outcome so dropped prefetches don't log "exception never retrieved"
+    if not task.cancelled():
+        task.exception()
 
+# Every worker process has its own system and cache over the shared SQLite
+# store, e.g. gunicorn -w 4 troupe_marketing:app (without --preload, so each
+# worker opens its own database connection)
 system = LeadManagementSystem()
 
 @app.route('/create_lead', methods=['POST', 'GET'])  # Added GET for testing
@@ -235,7 +585,7 @@ def create_lead():
         else:
             stream = request.form.get('stream') or request.args.get('stream')
         
-        lead_id, lead = asyncio.run(system.create_lead(stream))
+        lead_id, lead = run_async(system.create_lead(stream, prefetch=True))
         return jsonify({
             "lead_id": lead_id,
             "client": lead.client,
@@ -252,12 +602,193 @@ def create_lead():
 
 @app.route('/process_lead/<lead_id>', methods=['POST'])
 def process_lead(lead_id):
-    result = asyncio.run(system.process_lead(lead_id))
+    if system.get_lead(lead_id) is None:
+        return jsonify({"error": f"Unknown lead {lead_id}"}), 404
+    try:
+        result = run_async(system.process_lead(lead_id))
+    except (LeadBusyError, LeadConflictError) as e:
+        # The step is running or already ran elsewhere; the client can reload and retry
+        return jsonify({"error": str(e)}), 409
+    except Exception as e:
+        logger.error(f"Processing step for {lead_id} failed: {e}")
+        return jsonify({"error": str(e), "message": "Failed to process lead"}), 500
     return jsonify(result)
 
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+@app.route('/process_lead/<lead_id>/stream', methods=['POST'])
+def process_lead_stream(lead_id):
+    if system.get_lead(lead_id) is None:
+        return jsonify({"error": f"Unknown lead {lead_id}"}), 404
+
+    def events():
+        # The lease is taken on first iteration, inside the generator, so a
+        # client that leaves before the body is read leaves no lease behind;
+        # a busy lead is therefore reported as an error event, not a 409
+        try:
+            for event, payload in iterate_async(system.process_lead_stream(lead_id)):
+                if event == "token":
+                    yield sse_event("token", {"content": payload})
+                else:
+                    yield sse_event(event, payload)
+        except (LeadBusyError, LeadConflictError) as e:
+            yield sse_event("error", {"error": str(e), "status": 409})
+        except Exception as e:
+            logger.error(f"Streaming step for {lead_id} failed: {e}")
+            yield sse_event("error", {"error": str(e)})
+
+    return Response(events(), mimetype="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no"
+    })
+
+@app.route('/run_lead/<lead_id>', methods=['POST'])
+def run_lead(lead_id):
+    # Streams the whole remaining lifecycle of a lead as server-sent events
+    if system.get_lead(lead_id) is None:
+        return jsonify({"error": f"Unknown lead {lead_id}"}), 404
+    params = request.get_json(silent=True) or {}
+    max_steps = params.get('max_steps', request.args.get('max_steps'))
+    if max_steps is not None:
+        try:
+            max_steps = int(max_steps)
+        except (TypeError, ValueError):
+            max_steps = 0
+        if max_steps < 1:
+            return jsonify({"error": "max_steps must be a positive integer"}), 400
+
+    def events():
+        # Leased on first iteration, as in process_lead_stream
+        try:
+            for event, payload in iterate_async(system.run_lead(lead_id, max_steps=max_steps)):
+                yield sse_event(event, payload)
+        except (LeadBusyError, LeadConflictError) as e:
+            yield sse_event("error", {"error": str(e), "status": 409})
+        except Exception as e:
+            logger.error(f"Lifecycle run for {lead_id} failed: {e}")
+            yield sse_event("error", {"error": str(e)})
+
+    return Response(events(), mimetype="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no"
+    })
+
+@app.route('/lead/<lead_id>/memory', methods=['GET'])
+def lead_memory(lead_id):
+    lead = system.get_lead(lead_id)
+    if lead is None:
+        return jsonify({"error": f"Unknown lead {lead_id}"}), 404
+    return jsonify({
+        "lead_id": lead_id,
+        "summary": lead.memory.summary,
+        "recent_turns": lead.memory.turns,
+        "tokens": lead.memory.token_counts()
+    })
+
+@app.route('/leads', methods=['GET'])
+def list_leads():
+    filters = {name: request.args.get(name) for name in ('stage', 'stream', 'client', 'deal_status',
+                                                         'onboarding_status', 'assigned_employee')}
+    return jsonify(system.store.query(
+        page=request.args.get('page', default=1, type=int),
+        per_page=request.args.get('per_page', default=50, type=int),
+        **filters
+    ))
+
+@app.route('/lead/<lead_id>', methods=['GET'])
+def get_lead(lead_id):
+    lead = system.get_lead(lead_id)
+    if lead is None:
+        return jsonify({"error": f"Unknown lead {lead_id}"}), 404
+    record = lead.to_record()
+    record.pop("memory")
+    return jsonify(dict(record, lead_id=lead_id))
+
+@app.route('/lead/<lead_id>/turns', methods=['GET'])
+def lead_turns(lead_id):
+    return jsonify({
+        "lead_id": lead_id,
+        "turns": system.store.turns(
+            lead_id,
+            after_id=request.args.get('after', default=0, type=int),
+            limit=request.args.get('limit', default=100, type=int)
+        )
+    })
+
+@app.route('/funnel', methods=['GET'])
+def funnel():
+    # Served from the incremental counters; cost does not grow with the number of leads
+    window = request.args.get('window', type=int)
+    if window is not None and window <= 0:
+        return jsonify({"error": "window must be a positive number of seconds"}), 400
+    return jsonify(system.funnel.snapshot(window))
+
+# Largest /run_batch request; bigger simulations belong in batch_jobs.py
+RUN_BATCH_MAX_COUNT = int(os.getenv("RUN_BATCH_MAX_COUNT", 1000))
+
+@app.route('/run_batch', methods=['POST'])
+def run_batch():
+    try:
+        params = request.get_json(silent=True) or {}
+        count = int(params.get('count', 10))
+        concurrency = int(params.get('concurrency', 50))
+        stream = params.get('stream')
+        include_leads = bool(params.get('include_leads', False))
+
+        if count < 1:
+            return jsonify({"error": "count must be at least 1"}), 400
+        if count > RUN_BATCH_MAX_COUNT:
+            # Every lead is a live coroutine for the whole synchronous request
+            return jsonify({
+                "error": f"count must be at most {RUN_BATCH_MAX_COUNT}",
+                "message": "Use python batch_jobs.py leads --count N for larger runs"
+            }), 400
+
+        runner = LeadBatchRunner(system, concurrency=concurrency)
+        result = run_async(runner.run(count, stream))
+        if not include_leads:
+            result.pop("leads")
+        return jsonify(result)
+    except Exception as e:
+        return jsonify({
+            "error": str(e),
+            "message": "Failed to run batch"
+        }), 500
+
+@app.route('/simulate_funnel', methods=['POST'])
+def simulate_funnel_route():
+    # Monte Carlo capacity planning over the same transition rules, no LLM calls
+    try:
+        params = request.get_json(silent=True) or {}
+        leads = int(params.get('leads', 100000))
+        if not 1 <= leads <= 10_000_000:
+            return jsonify({"error": "leads must be between 1 and 10,000,000"}), 400
+
+        report = simulate_funnel(leads, params.get('probabilities'), seed=params.get('seed'),
+                                 workflow=WORKFLOW_ENGINE)
+        if not params.get('include_occupancy_by_step', False):
+            report["occupancy"].pop("by_step")
+        return jsonify(report)
+    except Exception as e:
+        return jsonify({
+            "error": str(e),
+            "message": "Failed to simulate funnel"
+        }), 500
+
+@app.route('/model_policy', methods=['GET'])
+def model_policy_stats():
+    # Per-route SLO state of the model tiering policy
+    return jsonify(get_policy().stats())
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return Response(render_prometheus(), mimetype=PROMETHEUS_CONTENT_TYPE)
+
 @app.route('/')
 def index():
     return send_from_directory('./templates', 'index.html')
 
 if __name__ == '__main__':
-    app.run(debug=True, port=3847)
\ No newline at end of file
+    # threaded=True lets Flask workers block on run_async while the shared loop overlaps their LLM calls
+    app.run(debug=True, port=3847, threaded=True)
\ No newline at end of file
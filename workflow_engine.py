@@ -0,0 +1,129 @@
+import json
+import os
+
+# Workflow definitions live in workflows/*.json (or .yaml) and are compiled
+# once at import time into index tables, so stage lookups and transitions
+# are O(1) dictionary/list accesses instead of scans over the stage list.
+#
+# A stage may declare "transitions": an ordered list of rules evaluated
+# against the lead status. The first rule whose "when" conditions all hold
+# wins; a rule without "when" always matches.
+#
+#   {"to": "Calling Desk", "when": [{"field": "assigned_employee", "op": "truthy"}]}
+#
+# Stages without rules but with exactly one possible_next move there
+# unconditionally. Stages with several possible_next and no rules are left
+# to the caller (e.g. an LLM routing decision) and next_stage returns None.
+
+WORKFLOW_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "workflows")
+
+OPERATORS = {
+    "eq": lambda actual, expected: actual == expected,
+    "ne": lambda actual, expected: actual != expected,
+    "in": lambda actual, expected: actual in expected,
+    "not_in": lambda actual, expected: actual not in expected,
+    "truthy": lambda actual, expected: bool(actual),
+    "falsy": lambda actual, expected: not actual,
+}
+
+
+class WorkflowError(ValueError):
+    pass
+
+
+class CompiledWorkflow:
+    def __init__(self, stages, name=None):
+        self.name = name
+        self.stages = list(stages)
+        self.names = [stage["stage"] for stage in self.stages]
+        self.index = {}
+
+        for idx, stage_name in enumerate(self.names):
+            if stage_name in self.index:
+                raise WorkflowError(f"Duplicate stage '{stage_name}' in workflow {name}")
+            self.index[stage_name] = idx
+
+        self.by_name = {stage["stage"]: stage for stage in self.stages}
+        self.adjacency = [self._compile_edges(stage) for stage in self.stages]
+        self.adjacency_sets = [frozenset(edges) for edges in self.adjacency]
+        self.rules = [self._compile_rules(idx, stage) for idx, stage in enumerate(self.stages)]
+
+    def _compile_edges(self, stage):
+        edges = []
+        for target in stage.get("possible_next", []):
+            if target not in self.index:
+                raise WorkflowError(f"Stage '{stage['stage']}' points to unknown stage '{target}'")
+            edges.append(self.index[target])
+        return tuple(edges)
+
+    def _compile_rules(self, idx, stage):
+        rules = []
+        for rule in stage.get("transitions", []):
+            target = rule.get("to")
+            if target not in self.index:
+                raise WorkflowError(f"Transition from '{stage['stage']}' to unknown stage '{target}'")
+            if self.index[target] not in self.adjacency_sets[idx]:
+                raise WorkflowError(f"Transition from '{stage['stage']}' to '{target}' is not in possible_next")
+
+            conditions = []
+            for condition in rule.get("when", []):
+                op = condition.get("op", "eq")
+                if op not in OPERATORS:
+                    raise WorkflowError(f"Unknown operator '{op}' in stage '{stage['stage']}'")
+                conditions.append((condition["field"], OPERATORS[op], condition.get("value")))
+            rules.append((tuple(conditions), self.index[target]))
+
+        # Single-exit stages without explicit rules transition unconditionally
+        if not rules and len(self.adjacency[idx]) == 1:
+            rules.append(((), self.adjacency[idx][0]))
+        return tuple(rules)
+
+    @classmethod
+    def from_file(cls, path):
+        with open(path, encoding="utf-8") as f:
+            if path.endswith((".yaml", ".yml")):
+                import yaml
+                definition = yaml.safe_load(f)
+            else:
+                definition = json.load(f)
+
+        if isinstance(definition, list):
+            return cls(definition, name=os.path.basename(path))
+        return cls(definition["stages"], name=definition.get("name", os.path.basename(path)))
+
+    @classmethod
+    def load(cls, name):
+        for extension in (".json", ".yaml", ".yml"):
+            path = os.path.join(WORKFLOW_DIR, name + extension)
+            if os.path.exists(path):
+                return cls.from_file(path)
+        raise WorkflowError(f"No workflow definition named '{name}' in {WORKFLOW_DIR}")
+
+    def __len__(self):
+        return len(self.stages)
+
+    def __contains__(self, stage_name):
+        return stage_name in self.index
+
+    def stage(self, stage_name):
+        return self.by_name[stage_name]
+
+    def index_of(self, stage_name):
+        return self.index.get(stage_name)
+
+    def is_allowed(self, current, target):
+        current_idx = self.index.get(current)
+        target_idx = self.index.get(target)
+        if current_idx is None or target_idx is None:
+            return False
+        return target_idx in self.adjacency_sets[current_idx]
+
+    def next_index(self, current_idx, status):
+        for conditions, target_idx in self.rules[current_idx]:
+            if all(op(status.get(field), value) for field, op, value in conditions):
+                return target_idx
+        return None
+
+    def next_stage(self, current, status):
+        target_idx = self.next_index(self.index[current], status)
+        return None if target_idx is None else self.names[target_idx]